@@ -0,0 +1,108 @@
+import math
+import time
+
+from aws_utils import dynamodb_buffered_update
+from collection_sequencer import collection_hold_s
+from treasury import (
+    ensure_treasury_index,
+    count_treasury_records,
+    min_payment_amount,
+    min_fee_amount,
+)
+import env
+
+admission_queue = {}
+admission_stats = {"admitted": 0, "wait_time_s": 0.0}
+
+request_tables = lambda: {
+    "mint": env.ALEO_MINT_REQUESTS_TABLE,
+    "burn": env.ALEO_BURN_REQUESTS_TABLE,
+}
+
+
+def treasury_capacity():
+    return min(
+        count_treasury_records(min_payment_amount(), math.inf) // 2,
+        count_treasury_records(min_fee_amount(), math.inf),
+    )
+
+
+def collection_capacity():
+    hold_s = collection_hold_s()
+    if not hold_s:
+        return env.REQUEST_WORKERS
+    return max(1, math.ceil(env.ADMISSION_HORIZON_S / hold_s))
+
+
+def queue_requests(requests):
+    request_keys = {request_key for request_key, _ in requests}
+    for request_key in list(admission_queue):
+        if request_key not in request_keys:
+            del admission_queue[request_key]
+    for request_key, request in sorted(
+        requests, key=lambda entry: entry[1]["creation_block_height"]
+    ):
+        _, queued_at = admission_queue.get(
+            request_key, (None, time.monotonic())
+        )
+        admission_queue[request_key] = (request, queued_at)
+
+
+async def admit_requests(in_pipeline, awaiting_records):
+    await ensure_treasury_index()
+    capacity = min(
+        collection_capacity() - in_pipeline,
+        treasury_capacity() - awaiting_records,
+    )
+    admitted = []
+    for request_key in list(admission_queue)[: max(capacity, 0)]:
+        request, queued_at = admission_queue.pop(request_key)
+        admission_stats["admitted"] += 1
+        admission_stats["wait_time_s"] += time.monotonic() - queued_at
+        if "queue_position" in request:
+            dynamodb_buffered_update(
+                request_tables()[request_key[0]],
+                {"request_id": request_key[1]},
+                {
+                    "queue_position": {"Action": "DELETE"},
+                    "estimated_wait_s": {"Action": "DELETE"},
+                },
+                set_only=False,
+            )
+        admitted.append((request_key, request))
+
+    for position, request_key in enumerate(admission_queue):
+        estimated_wait = estimate_wait_s(in_pipeline + len(admitted), position)
+        changes = {"queue_position": position + 1}
+        if estimated_wait is not None:
+            changes["estimated_wait_s"] = estimated_wait
+        dynamodb_buffered_update(
+            request_tables()[request_key[0]],
+            {"request_id": request_key[1]},
+            changes,
+        )
+    return admitted
+
+
+def estimate_wait_s(in_pipeline, position):
+    hold_s = collection_hold_s()
+    if hold_s is None:
+        return None
+    return math.ceil((in_pipeline + position + 1) * hold_s)
+
+
+def format_admission_stats(in_pipeline):
+    estimated_wait = (
+        estimate_wait_s(in_pipeline, len(admission_queue) - 1)
+        if admission_queue
+        else 0
+    )
+    admitted = admission_stats["admitted"]
+    return (
+        f"admission: {len(admission_queue)} queued, capacity "
+        f"{collection_capacity()} by collection throughput, "
+        f"{treasury_capacity()} by treasury, est. wait "
+        f"{'unknown' if estimated_wait is None else f'{estimated_wait}s'}, "
+        f"{admitted} admitted, avg queue time "
+        f"{admission_stats['wait_time_s'] / max(admitted, 1):.1f}s"
+    )
@@ -1,25 +1,36 @@
 import subprocess
 import env
 
-from http_utils import get_request
+from http_utils import get_request, post_request, HttpStatusError
+from confirmations import track_transaction, forget_transaction
 import json
 
 from aws_utils import (
-    dynamodb_scan,
     dynamodb_delete,
     dynamodb_update,
     dynamodb_get,
 )
 import asyncio
-from project_utils import utc_now_ms, ascync_run, record_to_amount
+from project_utils import (
+    utc_now_ms,
+    ascync_run,
+    ascync_run_batch,
+    record_to_amount,
+)
 import json
 import re
 from fake_useragent import UserAgent
+import os
+from os import path
+import uuid
+
+built_transactions = {}
 
 
 async def create_account():
     aleo_account_new_stdout = await ascync_run(
-        [f"{env.CARGO_BIN_DIR_PATH}snarkos", "account", "new"]
+        [f"{env.CARGO_BIN_DIR_PATH}snarkos", "account", "new"],
+        lane="decrypt",
     )
 
     stdout_lines = aleo_account_new_stdout.split("\n")
@@ -62,7 +73,8 @@ async def scan_records(
             "--view-key",
             view_key,
             *period_args,
-        ]
+        ],
+        lane="decrypt",
     )
     stdout_lines = stdout.split("\n")
     if stdout_lines[3] == "No records found":
@@ -73,68 +85,42 @@ async def scan_records(
 
 
 async def transfer_credits(
-    private_key, receiver_address, amount, record, fee_record, priority_fee=0
+    private_key,
+    receiver_address,
+    amount,
+    record,
+    fee_record,
+    priority_fee=0,
+    request_step=None,
 ):
     fee_record = f'"{fee_record}"'
     record = f'"{record}"'
-    stdout = await ascync_run(
-        [
-            f"{env.CARGO_BIN_DIR_PATH}snarkos",
-            "developer",
-            "execute",
-            env.ALEO_CREDITS_PROGRAM_ID,
-            "transfer_private",
-            record,
-            receiver_address,
-            f"{amount}u64",
-            "--query",
-            env.ALEO_API,
-            "--private-key",
-            private_key,
-            "--broadcast",
-            env.ALEO_BROADCAST_ENDPOINT,
-            "--fee",
-            priority_fee,
-            "--record",
-            fee_record,
-        ]
+    return await execute(
+        env.ALEO_CREDITS_PROGRAM_ID,
+        "transfer_private",
+        [record, receiver_address, f"{amount}u64"],
+        private_key,
+        fee_record,
+        priority_fee,
+        request_step=request_step,
     )
-    tx_ids = re.findall(r"at1[a-z0-9]{58}", stdout)
-    if not tx_ids:
-        raise Exception(stdout)
-    tx_id = tx_ids[0]
-    return tx_id
 
 
 async def split_credit(
     private_key,
     record,
     amount,
+    request_step=None,
 ):
     encoded_amount = f"{amount}u64"
     record = f'"{record}"'
-    stdout = await ascync_run(
-        [
-            f"{env.CARGO_BIN_DIR_PATH}snarkos",
-            "developer",
-            "execute",
-            env.ALEO_CREDITS_PROGRAM_ID,
-            "split",
-            record,
-            encoded_amount,
-            "--query",
-            env.ALEO_API,
-            "--private-key",
-            private_key,
-            "--broadcast",
-            env.ALEO_BROADCAST_ENDPOINT,
-        ]
+    return await execute(
+        env.ALEO_CREDITS_PROGRAM_ID,
+        "split",
+        [record, encoded_amount],
+        private_key,
+        request_step=request_step,
     )
-    tx_ids = re.findall(r"at1[a-z0-9]{58}", stdout)
-    if not tx_ids:
-        raise Exception(stdout)
-    tx_id = tx_ids[0]
-    return tx_id
 
 
 async def join_credits(
@@ -143,36 +129,198 @@ async def join_credits(
     record2,
     fee_record,
     priority_fee=0,
+    request_step=None,
 ):
     record1 = f'"{record1}"'
     record2 = f'"{record2}"'
     fee_record = f'"{fee_record}"'
-    stdout = await ascync_run(
-        [
-            f"{env.CARGO_BIN_DIR_PATH}snarkos",
-            "developer",
-            "execute",
-            env.ALEO_CREDITS_PROGRAM_ID,
-            "join",
-            record1,
-            record2,
-            "--query",
-            env.ALEO_API,
-            "--private-key",
+    return await execute(
+        env.ALEO_CREDITS_PROGRAM_ID,
+        "join",
+        [record1, record2],
+        private_key,
+        fee_record,
+        priority_fee,
+        request_step=request_step,
+    )
+
+
+def execute_command(
+    program_id,
+    function_name,
+    inputs,
+    private_key,
+    fee_record=None,
+    priority_fee=0,
+    action=None,
+):
+    cmd = [
+        f"{env.CARGO_BIN_DIR_PATH}snarkos",
+        "developer",
+        "execute",
+        program_id,
+        function_name,
+        *inputs,
+        "--query",
+        env.ALEO_API,
+        "--private-key",
+        private_key,
+    ]
+    cmd += action or ["--broadcast", env.ALEO_BROADCAST_ENDPOINT]
+    if fee_record is not None:
+        cmd += ["--fee", priority_fee, "--record", fee_record]
+    return cmd
+
+
+async def execute(
+    program_id,
+    function_name,
+    inputs,
+    private_key,
+    fee_record=None,
+    priority_fee=0,
+    request_step=None,
+):
+    transaction = None
+    if request_step is not None:
+        transaction = await load_built_transaction(request_step)
+    if transaction is not None and await is_transaction_on_chain(
+        transaction["id"]
+    ):
+        return transaction["id"]
+
+    if transaction is None:
+        transaction = await build_transaction(
+            program_id,
+            function_name,
+            inputs,
             private_key,
-            "--broadcast",
-            env.ALEO_BROADCAST_ENDPOINT,
-            "--fee",
-            priority_fee,
-            "--record",
             fee_record,
-        ]
+            priority_fee,
+        )
+        if request_step is not None:
+            await save_built_transaction(request_step, transaction)
+
+    await broadcast_built_transaction(transaction, request_step)
+    return transaction["id"]
+
+
+async def broadcast_built_transaction(transaction, request_step=None):
+    keep_built_transaction(transaction)
+    track_transaction(
+        transaction,
+        on_rejected=(
+            (lambda: delete_built_transaction(request_step))
+            if request_step is not None
+            else None
+        ),
+    )
+    try:
+        await broadcast_transaction(transaction)
+    except HttpStatusError as e:
+        if is_retryable_status(e.status):
+            raise e
+        if await is_transaction_on_chain(transaction["id"]):
+            return
+        forget_transaction(transaction["id"])
+        built_transactions.pop(transaction["id"], None)
+        if request_step is not None:
+            await delete_built_transaction(request_step)
+        raise e
+
+
+async def build_transaction(
+    program_id,
+    function_name,
+    inputs,
+    private_key,
+    fee_record=None,
+    priority_fee=0,
+):
+    store_path = path.join(
+        env.BUILT_TRANSACTIONS_DIR, f"{uuid.uuid4().hex}.json"
     )
-    tx_ids = re.findall(r"at1[a-z0-9]{58}", stdout)
-    if not tx_ids:
-        raise Exception(stdout)
-    tx_id = tx_ids[0]
-    return tx_id
+    try:
+        stdout = await ascync_run(
+            execute_command(
+                program_id,
+                function_name,
+                inputs,
+                private_key,
+                fee_record,
+                priority_fee,
+                action=["--store", store_path],
+            )
+        )
+        try:
+            with open(store_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            raise Exception(stdout)
+    finally:
+        if path.exists(store_path):
+            os.remove(store_path)
+
+
+async def load_built_transaction(request_step):
+    built_transaction = await dynamodb_get(
+        env.BUILT_TRANSACTIONS_TABLE,
+        {"request_step": request_step},
+        projection_expression="built_transaction",
+    )
+    if not built_transaction:
+        return None
+    return json.loads(built_transaction["built_transaction"])
+
+
+async def save_built_transaction(request_step, transaction):
+    await dynamodb_update(
+        env.BUILT_TRANSACTIONS_TABLE,
+        {"request_step": request_step},
+        {
+            "built_transaction": json.dumps(transaction),
+            "transaction_id": transaction["id"],
+            "expires_at": utc_now_ms() // 1000 + env.BUILT_TRANSACTIONS_TTL_S,
+        },
+    )
+
+
+async def delete_built_transaction(request_step):
+    await dynamodb_delete(
+        env.BUILT_TRANSACTIONS_TABLE, {"request_step": request_step}
+    )
+
+
+def keep_built_transaction(transaction):
+    built_transactions[transaction["id"]] = transaction
+    while len(built_transactions) > env.BUILT_TRANSACTIONS_CACHE_SIZE:
+        del built_transactions[next(iter(built_transactions))]
+
+
+is_retryable_status = lambda status: status >= 500 or status == 429
+
+
+async def broadcast_transaction(transaction):
+    for attempt in range(env.BROADCAST_RETRIES + 1):
+        try:
+            await post_request(env.ALEO_BROADCAST_ENDPOINT, transaction)
+            return
+        except Exception as e:
+            if attempt == env.BROADCAST_RETRIES or (
+                isinstance(e, HttpStatusError)
+                and not is_retryable_status(e.status)
+            ):
+                raise e
+            print(f"Broadcast of {transaction['id']} failed, retrying:", e)
+            await asyncio.sleep(env.BROADCAST_BACKOFF_MS * 2**attempt / 1000)
+
+
+async def is_transaction_on_chain(tx_id):
+    try:
+        transaction = await get_transaction(tx_id)
+    except Exception:
+        return False
+    return isinstance(transaction, dict) and transaction.get("id") == tx_id
 
 
 async def get_transaction(tx_id):
@@ -181,90 +329,125 @@ async def get_transaction(tx_id):
 
 
 async def get_transaction_outputs(tx_id, view_key):
-    transaction = await get_transaction(tx_id)
+    transaction = built_transactions.get(tx_id)
+    if transaction is None:
+        transaction = await get_transaction(tx_id)
     fee = transaction.get("fee")
 
     transitions = transaction["execution"]["transitions"] + (
         [transaction["fee"]["transition"]] if fee else []
     )
+    decrypted = await decrypt_records(
+        [
+            (output_cipher["value"], view_key)
+            for transition in transitions
+            for output_cipher in transition["outputs"]
+        ]
+    )
     outputs = {}
     for transition in transitions:
         transition_id = f'{transition["program"]}/{transition["function"]}'
-        output_ciphers = transition["outputs"]
-        outputs[transition_id] = [
-            await decrypt_record(output_cipher["value"], view_key)
-            for output_cipher in output_ciphers
-        ]
+        output_count = len(transition["outputs"])
+        outputs[transition_id] = decrypted[:output_count]
+        decrypted = decrypted[output_count:]
     return outputs
 
 
 async def decrypt_record(record, view_key):
     stdout = await ascync_run(
-        [
-            f"{env.CARGO_BIN_DIR_PATH}snarkos",
-            "developer",
-            "decrypt",
-            "--ciphertext",
-            record,
-            "--view-key",
-            view_key,
-        ]
+        decrypt_command(record, view_key), lane="decrypt"
     )
-    record = "".join(stdout.split("\n")[1:-1]).replace(" ", "")
-    if not record.startswith("{"):
-        return ""
-    return "".join(stdout.split("\n")[1:-1]).replace(" ", "")
-
-
-async def get_treasury_records():
-    treasury_records = await dynamodb_scan(env.ALEO_TREASURY_RECORDS_TABLE)
-    records = []
-    collection_record = None
-
-    for record_scanned in treasury_records:
-        if record_scanned.get("collection_record"):
-            collection_record = record_scanned["record_id"]
-            continue
-        records.append(
-            {
-                "record": record_scanned["record_id"],
-                "amount": record_to_amount(record_scanned["record_id"]),
-            }
-        )
-    records.sort(key=lambda x: x["amount"])
-    if len(records) < 2:
-        raise Exception("Not enough records in treasury.")
-    if not collection_record:
-        raise Exception("No collection record in treasury.")
-
-    biggest_record, smallest_record = records[-1], records[0]
-
-    await asyncio.gather(
-        dynamodb_delete(
-            env.ALEO_TREASURY_RECORDS_TABLE,
-            {"record_id": biggest_record["record"]},
-        ),
-        dynamodb_delete(
-            env.ALEO_TREASURY_RECORDS_TABLE,
-            {"record_id": smallest_record["record"]},
-        ),
-        dynamodb_delete(
-            env.ALEO_TREASURY_RECORDS_TABLE,
-            {"record_id": collection_record},
-        ),
+    return parse_decrypted_record(stdout)
+
+
+async def decrypt_records(records_view_keys):
+    chunks = [
+        records_view_keys[x : x + env.DECRYPT_BATCH_SIZE]
+        for x in range(0, len(records_view_keys), env.DECRYPT_BATCH_SIZE)
+    ]
+    chunks_stdouts = await asyncio.gather(
+        *[
+            ascync_run_batch(
+                [
+                    decrypt_command(record, view_key)
+                    for record, view_key in chunk
+                ]
+            )
+            for chunk in chunks
+        ]
     )
+    return [
+        parse_decrypted_record(stdout)
+        for stdouts in chunks_stdouts
+        for stdout in stdouts
+    ]
 
-    return (
-        smallest_record["record"],
-        biggest_record["record"],
-        collection_record,
+
+async def decrypt_records_until_match(records_view_keys):
+    results = [None] * len(records_view_keys)
+    chunk_starts = iter(
+        range(0, len(records_view_keys), env.SCAN_CREDITS_CHUNK_SIZE)
     )
+    in_flight = {}
+    matched = False
+    try:
+        while True:
+            while (
+                not matched
+                and len(in_flight) < env.SCAN_CREDITS_PARALLEL_CHUNKS
+            ):
+                chunk_start = next(chunk_starts, None)
+                if chunk_start is None:
+                    break
+                chunk = records_view_keys[
+                    chunk_start : chunk_start + env.SCAN_CREDITS_CHUNK_SIZE
+                ]
+                in_flight[asyncio.ensure_future(decrypt_records(chunk))] = (
+                    chunk_start
+                )
+            if not in_flight:
+                return results
+            done, _ = await asyncio.wait(
+                in_flight, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                chunk_start = in_flight.pop(task)
+                chunk_records = task.result()
+                results[chunk_start : chunk_start + len(chunk_records)] = (
+                    chunk_records
+                )
+            matched = any(results)
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+def decrypt_command(record, view_key):
+    return [
+        f"{env.CARGO_BIN_DIR_PATH}snarkos",
+        "developer",
+        "decrypt",
+        "--ciphertext",
+        record,
+        "--view-key",
+        view_key,
+    ]
+
+
+def parse_decrypted_record(stdout):
+    record = "".join(stdout.split("\n")[1:-1]).replace(" ", "")
+    if record.startswith("{"):
+        return record
+    if "Invalid view key for the provided record ciphertext" in stdout:
+        return ""
+    return None
 
 
 async def get_stored_token_record(token_number):
     treasury_record = await dynamodb_get(
         env.PRIVACY_PRIDE_STORED_TOKEN_RECORDS_TABLE,
         {"token_number": token_number},
+        projection_expression="token_record",
     )
     if not treasury_record:
         raise Exception("No corresponding token record in treasury.")
@@ -276,54 +459,25 @@ async def get_stored_token_record(token_number):
     return treasury_record["token_record"]
 
 
-async def push_treasury_records(records):
-    await asyncio.gather(
-        *[
-            dynamodb_update(
-                env.ALEO_TREASURY_RECORDS_TABLE,
-                {"record_id": record},
-                {"used_already": False, "collection_record": collection},
-            )
-            for (record, collection) in records
-        ]
-    )
-
-
 async def transfer_pp(
     private_key,
     amount_record,
     receiver_address,
     fee_record,
     priority_fee=0,
+    request_step=None,
 ):
     amount_record = f'"{amount_record}"'
     fee_record = f'"{fee_record}"'
-    stdout = await ascync_run(
-        [
-            f"{env.CARGO_BIN_DIR_PATH}snarkos",
-            "developer",
-            "execute",
-            env.PRIVACY_PRIDE_PROGRAM_ID,
-            "transfer_private",
-            amount_record,
-            receiver_address,
-            "--query",
-            env.ALEO_API,
-            "--private-key",
-            private_key,
-            "--broadcast",
-            env.ALEO_BROADCAST_ENDPOINT,
-            "--fee",
-            priority_fee,
-            "--record",
-            fee_record,
-        ]
+    return await execute(
+        env.PRIVACY_PRIDE_PROGRAM_ID,
+        "transfer_private",
+        [amount_record, receiver_address],
+        private_key,
+        fee_record,
+        priority_fee,
+        request_step=request_step,
     )
-    tx_ids = re.findall(r"at1[a-z0-9]{58}", stdout)
-    if not tx_ids:
-        raise Exception(stdout)
-    tx_id = tx_ids[0]
-    return tx_id
 
 
 async def transfer_token_private(
@@ -332,35 +486,19 @@ async def transfer_token_private(
     receiver_address,
     fee_record,
     priority_fee=0,
+    request_step=None,
 ):
     amount_record = f'"{amount_record}"'
     fee_record = f'"{fee_record}"'
-    stdout = await ascync_run(
-        [
-            f"{env.CARGO_BIN_DIR_PATH}snarkos",
-            "developer",
-            "execute",
-            env.ALEO_STORE_PROGRAM_ID,
-            "transfer_token_private",
-            amount_record,
-            receiver_address,
-            "--query",
-            env.ALEO_API,
-            "--private-key",
-            private_key,
-            "--broadcast",
-            env.ALEO_BROADCAST_ENDPOINT,
-            "--fee",
-            priority_fee,
-            "--record",
-            fee_record,
-        ]
+    return await execute(
+        env.ALEO_STORE_PROGRAM_ID,
+        "transfer_token_private",
+        [amount_record, receiver_address],
+        private_key,
+        fee_record,
+        priority_fee,
+        request_step=request_step,
     )
-    tx_ids = re.findall(r"at1[a-z0-9]{58}", stdout)
-    if not tx_ids:
-        raise Exception(stdout)
-    tx_id = tx_ids[0]
-    return tx_id
 
 
 async def burn_private(
@@ -369,36 +507,20 @@ async def burn_private(
     amount_record,
     fee_record,
     priority_fee=0,
+    request_step=None,
 ):
     amount_record = f'"{amount_record}"'
     collection_record = f'"{collection_record}"'
     fee_record = f'"{fee_record}"'
-    stdout = await ascync_run(
-        [
-            f"{env.CARGO_BIN_DIR_PATH}snarkos",
-            "developer",
-            "execute",
-            env.ALEO_STORE_PROGRAM_ID,
-            "burn_private",
-            collection_record,
-            amount_record,
-            "--query",
-            env.ALEO_API,
-            "--private-key",
-            private_key,
-            "--broadcast",
-            env.ALEO_BROADCAST_ENDPOINT,
-            "--fee",
-            priority_fee,
-            "--record",
-            fee_record,
-        ]
+    return await execute(
+        env.ALEO_STORE_PROGRAM_ID,
+        "burn_private",
+        [collection_record, amount_record],
+        private_key,
+        fee_record,
+        priority_fee,
+        request_step=request_step,
     )
-    tx_ids = re.findall(r"at1[a-z0-9]{58}", stdout)
-    if not tx_ids:
-        raise Exception(stdout)
-    tx_id = tx_ids[0]
-    return tx_id
 
 
 async def get_transaction_id(transition_id):
@@ -438,38 +560,20 @@ async def mint_private(
     metadata_uri,
     fee_record,
     priority_fee=0,
+    request_step=None,
 ):
     collection_record = f'"{collection_record}"'
     fee_record = f'"{fee_record}"'
     metadata_uri = '"{metadata_uri:' + metadata_uri + ',transferable:true}"'
-    stdout = await ascync_run(
-        [
-            f"{env.CARGO_BIN_DIR_PATH}snarkos",
-            "developer",
-            "execute",
-            env.ALEO_STORE_PROGRAM_ID,
-            "mint_private",
-            collection_record,
-            token_number,
-            user_address,
-            metadata_uri,
-            "--query",
-            env.ALEO_API,
-            "--private-key",
-            private_key,
-            "--broadcast",
-            env.ALEO_BROADCAST_ENDPOINT,
-            "--fee",
-            priority_fee,
-            "--record",
-            fee_record,
-        ]
+    return await execute(
+        env.ALEO_STORE_PROGRAM_ID,
+        "mint_private",
+        [collection_record, token_number, user_address, metadata_uri],
+        private_key,
+        fee_record,
+        priority_fee,
+        request_step=request_step,
     )
-    tx_ids = re.findall(r"at1[a-z0-9]{58}", stdout)
-    if not tx_ids:
-        raise Exception(stdout)
-    tx_id = tx_ids[0]
-    return tx_id
 
 
 def encode_string(string, part_amount, bits_per_part):
@@ -1,7 +1,12 @@
 import aioboto3
-from boto3.dynamodb.conditions import Attr
+from boto3.dynamodb.conditions import Attr, ConditionExpressionBuilder
+from boto3.dynamodb.types import DYNAMODB_CONTEXT
+from botocore.config import Config
+from contextlib import AsyncExitStack
+import asyncio
 import env
 import boto3
+from project_utils import format_error
 
 aioboto3_session = aioboto3.Session()
 aws_credentials = {
@@ -10,17 +15,66 @@ aws_credentials = {
     "region_name": env.AWS_REGION,
 }
 
+dynamodb_clients = []
+dynamodb_clients_stack = None
+dynamodb_clients_lock = None
+dynamodb_next_client = 0
+dynamodb_stats = {"clients_created": 0}
+
+dynamodb_pending_puts = {}
+dynamodb_pending_updates = {}
+dynamodb_flush_timer = None
+dynamodb_flush_tasks = set()
+
+
+async def open_dynamodb_clients():
+    global dynamodb_clients_stack, dynamodb_clients_lock
+    if dynamodb_clients_lock is None:
+        dynamodb_clients_lock = asyncio.Lock()
+    async with dynamodb_clients_lock:
+        if dynamodb_clients:
+            return
+        dynamodb_clients_stack = AsyncExitStack()
+        for _ in range(env.DYNAMODB_CLIENT_POOL_SIZE):
+            dynamodb_client = await dynamodb_clients_stack.enter_async_context(
+                aioboto3_session.client(
+                    "dynamodb",
+                    config=Config(
+                        max_pool_connections=env.DYNAMODB_MAX_POOL_CONNECTIONS
+                    ),
+                    **aws_credentials,
+                )
+            )
+            dynamodb_clients.append(dynamodb_client)
+            dynamodb_stats["clients_created"] += 1
 
-async def dynamodb_get(tablename, key_dic):
-    async with aioboto3_session.client(
-        "dynamodb", **aws_credentials
-    ) as dynamodb_client:
-        ret = await dynamodb_client.get_item(
-            TableName=tablename, Key=py_to_ddb(key_dic)
-        )
-        if "Item" not in ret:
-            return None
-        return ddb_to_py(ret["Item"])
+
+async def close_dynamodb_clients():
+    global dynamodb_clients_stack
+    if dynamodb_clients_stack is None:
+        return
+    await dynamodb_clients_stack.aclose()
+    dynamodb_clients.clear()
+    dynamodb_clients_stack = None
+
+
+async def get_dynamodb_client():
+    global dynamodb_next_client
+    if not dynamodb_clients:
+        await open_dynamodb_clients()
+    dynamodb_next_client = (dynamodb_next_client + 1) % len(dynamodb_clients)
+    return dynamodb_clients[dynamodb_next_client]
+
+
+async def dynamodb_get(tablename, key_dic, projection_expression=None):
+    get_args = {"TableName": tablename, "Key": py_to_ddb(key_dic)}
+    if projection_expression != None:
+        get_args["ProjectionExpression"] = projection_expression
+    dynamodb_client = await get_dynamodb_client()
+    ret = await dynamodb_client.get_item(**get_args)
+    if "Item" not in ret:
+        return None
+    return ddb_to_py(ret["Item"])
 
 
 async def dynamodb_update(tablename, key_dic, changes_dic, set_only=True):
@@ -30,29 +84,222 @@ async def dynamodb_update(tablename, key_dic, changes_dic, set_only=True):
             for upd_key, upd_val in changes_dic.items()
         }
     ddb_changes_dic = {
-        change_key: py_to_ddb(change_val)
+        change_key: {
+            **change_val,
+            **py_to_ddb(
+                {"Value": change_val["Value"]} if "Value" in change_val else {}
+            ),
+        }
         for change_key, change_val in changes_dic.items()
     }
-    async with aioboto3_session.client(
-        "dynamodb", **aws_credentials
-    ) as dynamodb_client:
+    dynamodb_client = await get_dynamodb_client()
+    await dynamodb_client.update_item(
+        TableName=tablename,
+        Key=py_to_ddb(key_dic),
+        AttributeUpdates=ddb_changes_dic,
+    )
+
+
+async def dynamodb_conditional_update(
+    tablename,
+    key_dic,
+    changes_dic,
+    condition_expression,
+    ExpressionAttributeValues=None,
+):
+    names = {f"#u{i}": key for i, key in enumerate(changes_dic)}
+    values = {f":u{i}": value for i, value in enumerate(changes_dic.values())}
+    dynamodb_client = await get_dynamodb_client()
+    try:
         await dynamodb_client.update_item(
             TableName=tablename,
             Key=py_to_ddb(key_dic),
-            AttributeUpdates=ddb_changes_dic,
+            UpdateExpression="SET "
+            + ", ".join(f"#u{i} = :u{i}" for i in range(len(changes_dic))),
+            ConditionExpression=condition_expression,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={
+                **py_to_ddb(values),
+                **(ExpressionAttributeValues or {}),
+            },
         )
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        return False
+    return True
 
 
-async def dynamodb_delete(tablename, key_dic):
-    async with aioboto3_session.client(
-        "dynamodb", **aws_credentials
-    ) as dynamodb_client:
-        return await dynamodb_client.delete_item(
-            TableName=tablename,
-            Key=py_to_ddb(key_dic),
-            ReturnValues="ALL_OLD",
+def dynamodb_buffered_update(
+    tablename, key_dic, changes_dic, set_only=True, put=False
+):
+    if set_only and not put:
+        changes_dic = {
+            upd_key: {"Value": upd_val}
+            for upd_key, upd_val in changes_dic.items()
+        }
+    buffer_key = (tablename, tuple(sorted(key_dic.items())))
+    if put:
+        dynamodb_pending_updates.pop(buffer_key, None)
+        _, put_changes = dynamodb_pending_puts.get(buffer_key, (None, {}))
+        dynamodb_pending_puts[buffer_key] = (
+            key_dic,
+            {**put_changes, **changes_dic},
+        )
+    elif buffer_key in dynamodb_pending_puts:
+        _, put_changes = dynamodb_pending_puts[buffer_key]
+        __apply_changes(put_changes, changes_dic)
+    else:
+        _, pending_changes = dynamodb_pending_updates.get(
+            buffer_key, (None, {})
+        )
+        dynamodb_pending_updates[buffer_key] = (
+            key_dic,
+            {**pending_changes, **changes_dic},
         )
 
+    if len(dynamodb_pending_puts) >= 25:
+        __schedule_flush(0)
+    else:
+        __schedule_flush(env.DYNAMODB_WRITE_BEHIND_FLUSH_MS / 1000)
+
+
+def __apply_changes(put_changes, changes_dic):
+    for change_key, change_val in changes_dic.items():
+        if "Value" in change_val:
+            put_changes[change_key] = change_val["Value"]
+        else:
+            put_changes.pop(change_key, None)
+
+
+def __requeue(tablename, key_dic, changes_dic, put):
+    buffer_key = (tablename, tuple(sorted(key_dic.items())))
+    if buffer_key in dynamodb_pending_puts:
+        return
+    _, newer_changes = dynamodb_pending_updates.pop(buffer_key, (None, {}))
+    if put:
+        put_changes = dict(changes_dic)
+        __apply_changes(put_changes, newer_changes)
+        dynamodb_pending_puts[buffer_key] = (key_dic, put_changes)
+    else:
+        dynamodb_pending_updates[buffer_key] = (
+            key_dic,
+            {**changes_dic, **newer_changes},
+        )
+    __schedule_flush(env.DYNAMODB_WRITE_BEHIND_FLUSH_MS / 1000)
+
+
+async def dynamodb_flush():
+    __start_flush()
+    flush_tasks = set(dynamodb_flush_tasks)
+    await asyncio.wait(flush_tasks)
+    for flush_task in flush_tasks:
+        if not flush_task.cancelled() and flush_task.exception() is not None:
+            raise flush_task.exception()
+
+
+def __schedule_flush(delay):
+    global dynamodb_flush_timer
+    if dynamodb_flush_timer is not None and not dynamodb_flush_timer.done():
+        if delay > 0:
+            return
+        dynamodb_flush_timer.cancel()
+    dynamodb_flush_timer = asyncio.ensure_future(__delayed_flush(delay))
+
+
+async def __delayed_flush(delay):
+    await asyncio.sleep(delay)
+    __start_flush()
+
+
+def __start_flush():
+    flush_task = asyncio.ensure_future(__flush_buffer())
+    dynamodb_flush_tasks.add(flush_task)
+    flush_task.add_done_callback(__on_flush_done)
+    return flush_task
+
+
+def __on_flush_done(flush_task):
+    dynamodb_flush_tasks.discard(flush_task)
+    if not flush_task.cancelled() and flush_task.exception() is not None:
+        print(format_error(flush_task.exception()))
+
+
+async def __flush_buffer():
+    puts = dict(dynamodb_pending_puts)
+    updates = dict(dynamodb_pending_updates)
+    dynamodb_pending_puts.clear()
+    dynamodb_pending_updates.clear()
+
+    puts_by_table = {}
+    for (tablename, _), put in puts.items():
+        puts_by_table.setdefault(tablename, []).append(put)
+
+    results = await asyncio.gather(
+        *[
+            __batch_put(tablename, table_puts[x : x + 25])
+            for tablename, table_puts in puts_by_table.items()
+            for x in range(0, len(table_puts), 25)
+        ],
+        *[
+            __buffered_update(tablename, key_dic, changes_dic)
+            for (tablename, _), (key_dic, changes_dic) in updates.items()
+        ],
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+
+async def __batch_put(tablename, puts):
+    request_items = {
+        tablename: [
+            {"PutRequest": {"Item": py_to_ddb({**changes_dic, **key_dic})}}
+            for key_dic, changes_dic in puts
+        ]
+    }
+    try:
+        dynamodb_client = await get_dynamodb_client()
+        for attempt in range(env.DYNAMODB_BATCH_WRITE_RETRIES):
+            response = await dynamodb_client.batch_write_item(
+                RequestItems=request_items
+            )
+            request_items = response.get("UnprocessedItems")
+            if not request_items:
+                return
+            await asyncio.sleep(0.05 * 2**attempt)
+        raise Exception(f"Unprocessed items left in {tablename}.")
+    except Exception as e:
+        for key_dic, changes_dic in puts:
+            __requeue(tablename, key_dic, changes_dic, True)
+        raise e
+
+
+async def __buffered_update(tablename, key_dic, changes_dic):
+    try:
+        await dynamodb_update(tablename, key_dic, changes_dic, set_only=False)
+    except Exception as e:
+        __requeue(tablename, key_dic, changes_dic, False)
+        raise e
+
+
+async def dynamodb_delete(
+    tablename,
+    key_dic,
+    condition_expression=None,
+    ExpressionAttributeValues=None,
+):
+    delete_args = {
+        "TableName": tablename,
+        "Key": py_to_ddb(key_dic),
+        "ReturnValues": "ALL_OLD",
+    }
+    if condition_expression != None:
+        delete_args["ConditionExpression"] = condition_expression
+    if ExpressionAttributeValues != None:
+        delete_args["ExpressionAttributeValues"] = ExpressionAttributeValues
+    dynamodb_client = await get_dynamodb_client()
+    return await dynamodb_client.delete_item(**delete_args)
+
 
 async def dynamodb_scan(
     table_name,
@@ -60,6 +307,59 @@ async def dynamodb_scan(
     is_in_list=None,
     is_in_attr="",
     ExpressionAttributeValues=None,
+    ExpressionAttributeNames=None,
+    projection_expression=None,
+    segments=1,
+):
+    return [
+        item
+        async for page in dynamodb_scan_pages(
+            table_name,
+            filter_expression=filter_expression,
+            is_in_list=is_in_list,
+            is_in_attr=is_in_attr,
+            ExpressionAttributeValues=ExpressionAttributeValues,
+            ExpressionAttributeNames=ExpressionAttributeNames,
+            projection_expression=projection_expression,
+            segments=segments,
+        )
+        for item in page
+    ]
+
+
+async def dynamodb_scan_items(table_name, **scan_kwargs):
+    async for page in dynamodb_scan_pages(table_name, **scan_kwargs):
+        for item in page:
+            yield item
+
+
+async def dynamodb_scan_pages(table_name, segments=1, **scan_kwargs):
+    scan_args = __build_scan_args(table_name, **scan_kwargs)
+    if scan_args is None:
+        return
+    async for response in __scan_responses(scan_args, segments):
+        yield [ddb_to_py(item) for item in response["Items"]]
+
+
+async def dynamodb_count(table_name, segments=1, **scan_kwargs):
+    scan_args = __build_scan_args(table_name, **scan_kwargs)
+    if scan_args is None:
+        return 0
+    scan_args["Select"] = "COUNT"
+    count = 0
+    async for response in __scan_responses(scan_args, segments):
+        count += response["Count"]
+    return count
+
+
+def __build_scan_args(
+    table_name,
+    filter_expression=None,
+    is_in_list=None,
+    is_in_attr="",
+    ExpressionAttributeValues=None,
+    ExpressionAttributeNames=None,
+    projection_expression=None,
 ):
     if is_in_list != None:
         chunks = [
@@ -67,7 +367,7 @@ async def dynamodb_scan(
         ]
 
         if len(chunks) == 0:
-            return []
+            return None
         filter_expression = Attr(is_in_attr).is_in(chunks[0])
         for i, chunk in enumerate(chunks):
             if i == 0:
@@ -75,52 +375,119 @@ async def dynamodb_scan(
             filter_expression = filter_expression | Attr(is_in_attr).is_in(
                 chunk
             )
+        built_expression = ConditionExpressionBuilder().build_expression(
+            filter_expression
+        )
+        filter_expression = built_expression.condition_expression
+        ExpressionAttributeNames = {
+            **(ExpressionAttributeNames or {}),
+            **built_expression.attribute_name_placeholders,
+        }
+        ExpressionAttributeValues = py_to_ddb(
+            built_expression.attribute_value_placeholders
+        )
 
-    async with aioboto3_session.client(
-        "dynamodb", **aws_credentials
-    ) as dynamodb_client:
-        if filter_expression == None:
-            response = await dynamodb_client.scan(TableName=table_name)
-        else:
-            response = await dynamodb_client.scan(
-                TableName=table_name,
-                FilterExpression=filter_expression,
-                **{"ExpressionAttributeValues": ExpressionAttributeValues}
-            )
-        data_ret = response["Items"]
-        while "LastEvaluatedKey" in response:
-            if filter_expression == None:
-                response = await dynamodb_client.scan(
-                    TableName=table_name,
-                    ExclusiveStartKey=response["LastEvaluatedKey"],
-                    **{"ExpressionAttributeValues": ExpressionAttributeValues}
-                )
-            else:
-                response = await dynamodb_client.scan(
-                    TableName=table_name,
-                    ExclusiveStartKey=response["LastEvaluatedKey"],
-                    FilterExpression=filter_expression,
-                    **{"ExpressionAttributeValues": ExpressionAttributeValues}
-                )
-            data_ret.extend(response["Items"])
+    scan_args = {"TableName": table_name}
+    if filter_expression != None:
+        scan_args["FilterExpression"] = filter_expression
+    if ExpressionAttributeValues != None:
+        scan_args["ExpressionAttributeValues"] = ExpressionAttributeValues
+    if ExpressionAttributeNames != None:
+        scan_args["ExpressionAttributeNames"] = ExpressionAttributeNames
+    if projection_expression != None:
+        scan_args["ProjectionExpression"] = projection_expression
+    return scan_args
 
-        return [ddb_to_py(item) for item in data_ret]
 
+async def __scan_responses(scan_args, segments):
+    if segments <= 1:
+        async for response in __scan_segment_responses(scan_args):
+            yield response
+        return
 
-async def create_table(table_name, key_name, key_type):
-    async with aioboto3_session.client(
-        "dynamodb", **aws_credentials
-    ) as dynamodb_client:
-        await dynamodb_client.create_table(
-            TableName=table_name,
-            KeySchema=[
-                {"AttributeName": key_name, "KeyType": "HASH"},
-            ],
-            AttributeDefinitions=[
-                {"AttributeName": key_name, "AttributeType": key_type},
-            ],
-            BillingMode="PAY_PER_REQUEST",
+    responses = asyncio.Queue(maxsize=segments)
+
+    async def scan_segment(segment):
+        try:
+            async for response in __scan_segment_responses(
+                {**scan_args, "Segment": segment, "TotalSegments": segments}
+            ):
+                await responses.put(response)
+            await responses.put(None)
+        except Exception as e:
+            await responses.put(e)
+
+    tasks = [
+        asyncio.ensure_future(scan_segment(segment))
+        for segment in range(segments)
+    ]
+    try:
+        remaining_segments = segments
+        while remaining_segments:
+            response = await responses.get()
+            if response is None:
+                remaining_segments -= 1
+                continue
+            if isinstance(response, Exception):
+                raise response
+            yield response
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def __scan_segment_responses(scan_args):
+    dynamodb_client = await get_dynamodb_client()
+    response = await dynamodb_client.scan(**scan_args)
+    yield response
+    while "LastEvaluatedKey" in response:
+        response = await dynamodb_client.scan(
+            ExclusiveStartKey=response["LastEvaluatedKey"], **scan_args
+        )
+        yield response
+
+
+async def dynamodb_query(
+    table_name,
+    key_condition_expression,
+    index_name=None,
+    filter_expression=None,
+    ExpressionAttributeValues=None,
+):
+    query_args = {
+        "TableName": table_name,
+        "KeyConditionExpression": key_condition_expression,
+        "ExpressionAttributeValues": ExpressionAttributeValues,
+    }
+    if index_name is not None:
+        query_args["IndexName"] = index_name
+    if filter_expression is not None:
+        query_args["FilterExpression"] = filter_expression
+
+    dynamodb_client = await get_dynamodb_client()
+    response = await dynamodb_client.query(**query_args)
+    data_ret = response["Items"]
+    while "LastEvaluatedKey" in response:
+        response = await dynamodb_client.query(
+            ExclusiveStartKey=response["LastEvaluatedKey"], **query_args
         )
+        data_ret.extend(response["Items"])
+
+    return [ddb_to_py(item) for item in data_ret]
+
+
+async def create_table(table_name, key_name, key_type):
+    dynamodb_client = await get_dynamodb_client()
+    await dynamodb_client.create_table(
+        TableName=table_name,
+        KeySchema=[
+            {"AttributeName": key_name, "KeyType": "HASH"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": key_name, "AttributeType": key_type},
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
 
 
 async def dynamodb_truncate_table(table_name):
@@ -164,12 +531,43 @@ async def s3_upload(im_path, bucket, relpath):
 boto3.resource("dynamodb", **aws_credentials)
 
 
+MAX_FAST_INT = 10**38
+
+type_deserializer = boto3.dynamodb.types.TypeDeserializer()
+type_serializer = boto3.dynamodb.types.TypeSerializer()
+
+
+def ddb_value_to_py(ddb_value):
+    if "S" in ddb_value:
+        return ddb_value["S"]
+    if "N" in ddb_value:
+        return DYNAMODB_CONTEXT.create_decimal(ddb_value["N"])
+    if "M" in ddb_value:
+        return {k: ddb_value_to_py(v) for k, v in ddb_value["M"].items()}
+    if "BOOL" in ddb_value:
+        return ddb_value["BOOL"]
+    if "NULL" in ddb_value:
+        return None
+    return type_deserializer.deserialize(ddb_value)
+
+
+def py_value_to_ddb(py_value):
+    py_type = type(py_value)
+    if py_type is str:
+        return {"S": py_value}
+    if py_type is bool:
+        return {"BOOL": py_value}
+    if py_type is int and -MAX_FAST_INT < py_value < MAX_FAST_INT:
+        return {"N": str(py_value)}
+    if py_type is dict:
+        return {"M": {k: py_value_to_ddb(v) for k, v in py_value.items()}}
+    if py_value is None:
+        return {"NULL": True}
+    return type_serializer.serialize(py_value)
+
+
 ddb_to_py = lambda ddb_data: {
-    k: boto3.dynamodb.types.TypeDeserializer().deserialize(v)
-    for k, v in ddb_data.items()
+    k: ddb_value_to_py(v) for k, v in ddb_data.items()
 }
 
-py_to_ddb = lambda py_data: {
-    k: boto3.dynamodb.types.TypeSerializer().serialize(v)
-    for k, v in py_data.items()
-}
+py_to_ddb = lambda py_data: {k: py_value_to_ddb(v) for k, v in py_data.items()}
@@ -0,0 +1,75 @@
+import time
+import boto3
+from aws_utils import ddb_to_py, py_to_ddb
+
+ITEMS = 2000
+ROUNDS = 5
+
+legacy_ddb_to_py = lambda ddb_data: {
+    k: boto3.dynamodb.types.TypeDeserializer().deserialize(v)
+    for k, v in ddb_data.items()
+}
+
+legacy_py_to_ddb = lambda py_data: {
+    k: boto3.dynamodb.types.TypeSerializer().serialize(v)
+    for k, v in py_data.items()
+}
+
+
+def make_request_item(i):
+    record = "{owner:aleo1" + "x" * 58 + ".private,microcredits:" + "1" * 12
+    return {
+        "request_id": f"request-{i}",
+        "creation_block_height": 500000 + i,
+        "request_status": "active",
+        "recipient_view_key": "AViewKey1" + "v" * 44,
+        "recipient_private_key": "APrivateKey1" + "p" * 47,
+        "recipient_address": "aleo1" + "a" * 58,
+        "user_address": "aleo1" + "u" * 58,
+        "scan_pp_output": {
+            "pp_data": {
+                "token_id": i,
+                "edition": 0,
+                "token_number": f"{i}u128",
+            },
+            "received_record": record * 8,
+            "transaction_id": "at1" + "t" * 58,
+        },
+        "scan_former_output": {
+            "payment_record": record * 4,
+            "fee_record": record * 4,
+            "collection_record": record * 4,
+        },
+        "transfer_credits_fees_output": {"tx_id": "at1" + "f" * 58},
+        "transfer_credits_fees_error": "Traceback\n" * 200,
+        "not_possible": False,
+    }
+
+
+def bench(name, marshal, items):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for item in items:
+            marshal(item)
+    elapsed = time.perf_counter() - start
+    items_per_s = ROUNDS * len(items) / elapsed
+    print(f"{name:<24}{items_per_s:>12.0f} items/s")
+    return items_per_s
+
+
+if __name__ == "__main__":
+    py_items = [make_request_item(i) for i in range(ITEMS)]
+    ddb_items = [legacy_py_to_ddb(item) for item in py_items]
+
+    if [ddb_to_py(item) for item in ddb_items] != [
+        legacy_ddb_to_py(item) for item in ddb_items
+    ] or [py_to_ddb(item) for item in py_items] != ddb_items:
+        raise Exception("Marshalling output differs from boto3.")
+
+    for direction, legacy, current, items in [
+        ("ddb_to_py", legacy_ddb_to_py, ddb_to_py, ddb_items),
+        ("py_to_ddb", legacy_py_to_ddb, py_to_ddb, py_items),
+    ]:
+        before = bench(f"{direction} before", legacy, items)
+        after = bench(f"{direction} after", current, items)
+        print(f"{direction} speedup: {after / before:.1f}x")
@@ -1,30 +1,55 @@
 import asyncio
-from aws_utils import dynamodb_update, dynamodb_scan
+from aws_utils import (
+    dynamodb_update,
+    dynamodb_buffered_update,
+    dynamodb_flush,
+    dynamodb_query,
+)
 from aleo import (
     create_account,
     transfer_credits,
     get_transaction_outputs,
-    get_treasury_records,
     get_stored_token_record,
-    push_treasury_records,
-    decrypt_record,
+    decrypt_records_until_match,
     encode_string64,
     transfer_token_private,
     burn_private,
     transfer_pp,
 )
+from confirmations import wait_for_confirmation
+from step_graph import run_step_graph
+from treasury import allocate_treasury_records, push_treasury_records
+from collection_sequencer import run_collection_operation
+from decrypt_memo import (
+    load_decrypt_misses,
+    is_decrypt_miss,
+    add_decrypt_miss,
+    forget_decrypt_misses,
+)
 import env
 from project_utils import record_to_amount, format_error, record_to_as_data
 
 
 async def get_burn_requests(cur_height):
     height_limit = cur_height - env.REQUESTS_SCAN_HEIGHT_LIMIT
-    requests = await dynamodb_scan(
-        env.ALEO_BURN_REQUESTS_TABLE,
-        filter_expression=f"(creation_block_height >= :height_limit or attribute_exists(scan_pp_output)) and attribute_not_exists(scan_transfer_pp_output) and attribute_not_exists(not_possible)",
-        ExpressionAttributeValues={":height_limit": {"N": str(height_limit)}},
+    pending_requests, active_requests = await asyncio.gather(
+        dynamodb_query(
+            env.ALEO_BURN_REQUESTS_TABLE,
+            "request_status = :pending and creation_block_height >= :height_limit",
+            index_name=env.REQUESTS_STATUS_INDEX,
+            ExpressionAttributeValues={
+                ":pending": {"S": "pending"},
+                ":height_limit": {"N": str(height_limit)},
+            },
+        ),
+        dynamodb_query(
+            env.ALEO_BURN_REQUESTS_TABLE,
+            "request_status = :active",
+            index_name=env.REQUESTS_STATUS_INDEX,
+            ExpressionAttributeValues={":active": {"S": "active"}},
+        ),
     )
-    return requests
+    return pending_requests + active_requests
 
 
 async def burn_scan_records(request, cur_height, burn_transfer_transactions):
@@ -67,96 +92,144 @@ async def handle_active_burn_request(request, cur_height):
     transfer_pp_output = request.get("transfer_pp_output", None)
     scan_transfer_pp_output = request.get("scan_transfer_pp_output", None)
 
-    try:
-        scan_former_output = await make_scan_former(
-            request_id,
-            scan_pp_output["as_data"]["token_number"],
-            scan_former_output,
-        )
-        has_worked = not bool(transfer_credits_fees_output)
-        transfer_credits_fees_output = await make_transfer_credits_fees(
-            request_id,
-            recipient_address,
-            scan_former_output["payment_record"],
-            scan_former_output["fee_record"],
-            transfer_credits_fees_output,
-        )
-        if has_worked:
-            await asyncio.sleep(15)
-        scan_transfer_credits_fees_output = (
-            await make_scan_transfer_credits_fees(
+    steps = {
+        "scan_former_output": (
+            [],
+            lambda outputs: make_scan_former(
+                request_id,
+                scan_pp_output["as_data"]["token_number"],
+                scan_former_output,
+            ),
+        ),
+        "transfer_credits_fees_output": (
+            ["scan_former_output"],
+            lambda outputs: make_transfer_credits_fees(
+                request_id,
+                recipient_address,
+                outputs["scan_former_output"]["payment_record"],
+                outputs["scan_former_output"]["fee_record"],
+                transfer_credits_fees_output,
+            ),
+        ),
+        "scan_transfer_credits_fees_output": (
+            ["transfer_credits_fees_output"],
+            lambda outputs: make_scan_transfer_credits_fees(
                 request_id,
-                transfer_credits_fees_output["tx_id"],
+                outputs["transfer_credits_fees_output"]["tx_id"],
                 recipient_view_key,
                 scan_transfer_credits_fees_output,
-            )
-        )
-        has_worked = not bool(transfer_as_output)
-        transfer_as_output = await make_transfer_as(
-            request_id,
-            recipient_private_key,
-            scan_pp_output["received_record"],
-            scan_transfer_credits_fees_output["transfer_output_record"],
-            transfer_as_output,
-        )
-        if has_worked:
-            await asyncio.sleep(15)
-        scan_transfer_as_output = await make_scan_transfer_as(
-            request_id,
-            scan_pp_output["as_data"]["token_number"],
-            transfer_as_output["tx_id"],
-            scan_transfer_as_output,
-        )
-        has_worked = not bool(burn_output)
-        burn_output = await make_burn(
-            request_id,
-            scan_former_output["collection_record"],
-            scan_transfer_as_output["as_record"],
-            scan_transfer_credits_fees_output["payment_output_record"],
-            burn_output,
-        )
-        if has_worked:
-            await asyncio.sleep(15)
-
-        scan_burn_output = await make_scan_burn(
-            request_id,
-            burn_output["tx_id"],
-            scan_burn_output,
-        )
-
-        has_worked = not bool(transfer_pp_output)
-        transfer_pp_output = await make_transfer_pp(
-            request_id,
-            user_address,
-            scan_former_output["stored_token_record"],
-            scan_transfer_credits_fees_output["fee_output_record"],
-            transfer_pp_output,
-        )
-        if has_worked:
-            await asyncio.sleep(15)
-
-        scan_transfer_pp_output = await make_scan_transfer_pp(
-            request_id,
-            scan_burn_output["fee_output_record"],
-            scan_burn_output["collection_output_record"],
-            transfer_pp_output["tx_id"],
-            scan_transfer_pp_output,
-        )
+            ),
+        ),
+        "transfer_credits_fees_confirmed": (
+            ["transfer_credits_fees_output"],
+            lambda outputs: wait_for_confirmation(
+                outputs["transfer_credits_fees_output"]["tx_id"]
+            ),
+        ),
+        "transfer_as_output": (
+            [
+                "scan_transfer_credits_fees_output",
+                "transfer_credits_fees_confirmed",
+            ],
+            lambda outputs: make_transfer_as(
+                request_id,
+                recipient_private_key,
+                scan_pp_output["received_record"],
+                outputs["scan_transfer_credits_fees_output"][
+                    "transfer_output_record"
+                ],
+                transfer_as_output,
+            ),
+        ),
+        "scan_transfer_as_output": (
+            ["transfer_as_output"],
+            lambda outputs: make_scan_transfer_as(
+                request_id,
+                scan_pp_output["as_data"]["token_number"],
+                outputs["transfer_as_output"]["tx_id"],
+                scan_transfer_as_output,
+            ),
+        ),
+        "transfer_as_confirmed": (
+            ["transfer_as_output"],
+            lambda outputs: wait_for_confirmation(
+                outputs["transfer_as_output"]["tx_id"]
+            ),
+        ),
+        "burn_output": (
+            [
+                "scan_transfer_credits_fees_output",
+                "scan_transfer_as_output",
+                "transfer_as_confirmed",
+            ],
+            lambda outputs: make_burn(
+                request_id,
+                outputs["scan_transfer_as_output"]["as_record"],
+                outputs["scan_transfer_credits_fees_output"][
+                    "payment_output_record"
+                ],
+                burn_output,
+            ),
+        ),
+        "scan_burn_output": (
+            ["burn_output"],
+            lambda outputs: make_scan_burn(
+                request_id,
+                outputs["burn_output"]["tx_id"],
+                scan_burn_output,
+            ),
+        ),
+        "burn_confirmed": (
+            ["burn_output"],
+            lambda outputs: wait_for_confirmation(
+                outputs["burn_output"]["tx_id"]
+            ),
+        ),
+        "transfer_pp_output": (
+            [
+                "scan_former_output",
+                "scan_transfer_credits_fees_output",
+                "transfer_credits_fees_confirmed",
+            ],
+            lambda outputs: make_transfer_pp(
+                request_id,
+                user_address,
+                outputs["scan_former_output"]["stored_token_record"],
+                outputs["scan_transfer_credits_fees_output"][
+                    "fee_output_record"
+                ],
+                transfer_pp_output,
+            ),
+        ),
+        "transfer_pp_confirmed": (
+            ["transfer_pp_output"],
+            lambda outputs: wait_for_confirmation(
+                outputs["transfer_pp_output"]["tx_id"]
+            ),
+        ),
+        "scan_transfer_pp_output": (
+            [
+                "scan_burn_output",
+                "burn_confirmed",
+                "transfer_pp_output",
+                "transfer_pp_confirmed",
+            ],
+            lambda outputs: make_scan_transfer_pp(
+                request_id,
+                outputs["scan_burn_output"]["fee_output_record"],
+                outputs["transfer_pp_output"]["tx_id"],
+                scan_transfer_pp_output,
+            ),
+        ),
+    }
 
+    try:
+        await run_step_graph(steps)
     except Exception as e:
         print(format_error(e))
         return
 
 
-async def decrypt_transaction_record(transaction, recipient_view_key):
-    return {
-        "transaction_id": transaction["transaction_id"],
-        "record": await decrypt_record(
-            transaction["encrypted_record"], recipient_view_key
-        ),
-    }
-
-
 async def make_scan_credits(
     request_id,
     recipient_view_key,
@@ -168,26 +241,61 @@ async def make_scan_credits(
     if scan_pp_output:
         return scan_pp_output
 
-    decrypted = await asyncio.gather(
-        *[
-            decrypt_transaction_record(transaction, recipient_view_key)
+    await load_decrypt_misses(recipient_view_key)
+    burn_transfer_transactions = sorted(
+        [
+            transaction
+            for transaction in burn_transfer_transactions
+            if transaction["discovery_height"] >= creation_block_height
+            and not is_decrypt_miss(
+                recipient_view_key, transaction["transaction_id"]
+            )
+        ],
+        key=lambda transaction: transaction["discovery_height"],
+    )
+    records = await decrypt_records_until_match(
+        [
+            (transaction["encrypted_record"], recipient_view_key)
             for transaction in burn_transfer_transactions
         ]
     )
-    decrypted = [dec for dec in decrypted if dec["record"]]
+    for transaction, record in zip(burn_transfer_transactions, records):
+        if record == "":
+            add_decrypt_miss(
+                recipient_view_key,
+                transaction["transaction_id"],
+                transaction["discovery_height"],
+            )
+    decrypted = [
+        {"transaction_id": transaction["transaction_id"], "record": record}
+        for transaction, record in zip(burn_transfer_transactions, records)
+        if record
+    ]
     if len(decrypted) == 0:
         raise Exception("No records found.")
 
-    received_record = decrypted[0]["record"]
-    transaction_id = decrypted[0]["transaction_id"]
+    return await save_burn_scan_pp_output(
+        request_id,
+        recipient_view_key,
+        decrypted[0]["transaction_id"],
+        decrypted[0]["record"],
+    )
+
 
+async def save_burn_scan_pp_output(
+    request_id, recipient_view_key, transaction_id, received_record
+):
     try:
         as_data = record_to_as_data(received_record)
     except:
         await dynamodb_update(
             env.ALEO_BURN_REQUESTS_TABLE,
             {"request_id": request_id},
-            {"not_possible": True},
+            {
+                "not_possible": {"Value": True},
+                "request_status": {"Action": "DELETE"},
+            },
+            set_only=False,
         )
         raise Exception("Not possible.")
 
@@ -196,17 +304,18 @@ async def make_scan_credits(
         "received_record": received_record,
         "transaction_id": transaction_id,
     }
+    dynamodb_buffered_update(
+        env.ALEO_BURN_REQUESTS_TABLE,
+        {"request_id": request_id},
+        {"scan_pp_output": scan_pp_output, "request_status": "active"},
+    )
+    dynamodb_buffered_update(
+        env.KNOWN_BURN_TRANSACTION_IDS_TABLE,
+        {"transaction_id": transaction_id},
+        {"used_already": True},
+    )
     await asyncio.gather(
-        dynamodb_update(
-            env.ALEO_BURN_REQUESTS_TABLE,
-            {"request_id": request_id},
-            {"scan_pp_output": scan_pp_output},
-        ),
-        dynamodb_update(
-            env.KNOWN_TRANSACTION_IDS_TABLE,
-            {"transaction_id": transaction_id},
-            {"used_already": True},
-        ),
+        dynamodb_flush(), forget_decrypt_misses(recipient_view_key)
     )
     return scan_pp_output
 
@@ -219,35 +328,32 @@ async def make_scan_former(
     if scan_former_output:
         return scan_former_output
     try:
-        (
-            payment_record,
-            fee_record,
-            collection_record,
-        ) = await get_treasury_records()
+        payment_record, fee_record = await allocate_treasury_records()
 
         try:
             stored_token_record = await get_stored_token_record(token_number)
         except Exception as e:
-            await asyncio.gather(
-                push_treasury_records(
-                    [
-                        (payment_record, False),
-                        (fee_record, False),
-                        (collection_record, True),
-                    ]
-                ),
-                dynamodb_update(
-                    env.ALEO_BURN_REQUESTS_TABLE,
-                    {"request_id": request_id},
-                    {"not_possible": True},
-                ),
+            push_treasury_records(
+                [
+                    (payment_record, False),
+                    (fee_record, False),
+                ]
+            )
+            dynamodb_buffered_update(
+                env.ALEO_BURN_REQUESTS_TABLE,
+                {"request_id": request_id},
+                {
+                    "not_possible": {"Value": True},
+                    "request_status": {"Action": "DELETE"},
+                },
+                set_only=False,
             )
+            await dynamodb_flush()
             raise e
 
         scan_former_output = {
             "payment_record": payment_record,
             "fee_record": fee_record,
-            "collection_record": collection_record,
             "stored_token_record": stored_token_record,
         }
         await dynamodb_update(
@@ -257,7 +363,7 @@ async def make_scan_former(
         )
         return scan_former_output
     except Exception as e:
-        await dynamodb_update(
+        dynamodb_buffered_update(
             env.ALEO_BURN_REQUESTS_TABLE,
             {"request_id": request_id},
             {"scan_scan_former_error": format_error(e)},
@@ -281,6 +387,7 @@ async def make_transfer_credits_fees(
             env.TRANSFER_LEOS_FEE,
             amount_record,
             fee_record,
+            request_step=f"burn/{request_id}/transfer_credits_fees",
         )
         transfer_credits_fees_output = {"tx_id": tx_id}
         await dynamodb_update(
@@ -290,7 +397,7 @@ async def make_transfer_credits_fees(
         )
         return transfer_credits_fees_output
     except Exception as e:
-        await dynamodb_update(
+        dynamodb_buffered_update(
             env.ALEO_BURN_REQUESTS_TABLE,
             {"request_id": request_id},
             {"transfer_credits_fees_error": format_error(e)},
@@ -336,7 +443,7 @@ async def make_scan_transfer_credits_fees(
         )
         return scan_transfer_credits_fees_output
     except Exception as e:
-        await dynamodb_update(
+        dynamodb_buffered_update(
             env.ALEO_BURN_REQUESTS_TABLE,
             {"request_id": request_id},
             {"scan_transfer_credits_fees_error": format_error(e)},
@@ -359,6 +466,7 @@ async def make_transfer_as(
             leo_record,
             env.MINT_ACCOUNT_ADDRESS,
             fee_record,
+            request_step=f"burn/{request_id}/transfer_as",
         )
         transfer_as_output = {"tx_id": tx_id}
         await dynamodb_update(
@@ -368,7 +476,7 @@ async def make_transfer_as(
         )
         return transfer_as_output
     except Exception as e:
-        await dynamodb_update(
+        dynamodb_buffered_update(
             env.ALEO_BURN_REQUESTS_TABLE,
             {"request_id": request_id},
             {"transfer_as_error": format_error(e)},
@@ -395,21 +503,20 @@ async def make_scan_transfer_as(
                 f"{env.ALEO_STORE_PROGRAM_ID}/transfer_token_private"
             ][0],
         }
-        await asyncio.gather(
-            dynamodb_update(
-                env.ALEO_BURN_REQUESTS_TABLE,
-                {"request_id": request_id},
-                {"scan_transfer_as_output": scan_transfer_as_output},
-            ),
-            dynamodb_update(
-                env.PRIVACY_PRIDE_STORED_TOKEN_RECORDS_TABLE,
-                {"token_number": token_number},
-                {"token_record": scan_transfer_as_output["as_record"]},
-            ),
+        dynamodb_buffered_update(
+            env.ALEO_BURN_REQUESTS_TABLE,
+            {"request_id": request_id},
+            {"scan_transfer_as_output": scan_transfer_as_output},
         )
+        dynamodb_buffered_update(
+            env.PRIVACY_PRIDE_STORED_TOKEN_RECORDS_TABLE,
+            {"token_number": token_number},
+            {"token_record": scan_transfer_as_output["as_record"]},
+        )
+        await dynamodb_flush()
         return scan_transfer_as_output
     except Exception as e:
-        await dynamodb_update(
+        dynamodb_buffered_update(
             env.ALEO_BURN_REQUESTS_TABLE,
             {"request_id": request_id},
             {"scan_transfer_as_error": format_error(e)},
@@ -419,7 +526,6 @@ async def make_scan_transfer_as(
 
 async def make_burn(
     request_id,
-    collection_record,
     token_record,
     fee_record,
     burn_output,
@@ -427,11 +533,17 @@ async def make_burn(
     if burn_output:
         return burn_output
     try:
-        tx_id = await burn_private(
-            env.MINT_ACCOUNT_PRIVATE_KEY,
-            collection_record,
-            token_record,
-            fee_record,
+        request_step = f"burn/{request_id}/burn"
+        tx_id = await run_collection_operation(
+            request_step,
+            (f"{env.ALEO_STORE_PROGRAM_ID}/burn_private", 0),
+            lambda collection_record: burn_private(
+                env.MINT_ACCOUNT_PRIVATE_KEY,
+                collection_record,
+                token_record,
+                fee_record,
+                request_step=request_step,
+            ),
         )
         burn_output = {"tx_id": tx_id}
         await dynamodb_update(
@@ -441,7 +553,7 @@ async def make_burn(
         )
         return burn_output
     except Exception as e:
-        await dynamodb_update(
+        dynamodb_buffered_update(
             env.ALEO_BURN_REQUESTS_TABLE,
             {"request_id": request_id},
             {"burn_error": format_error(e)},
@@ -463,9 +575,6 @@ async def make_scan_burn(
         )
 
         scan_burn_output = {
-            "collection_output_record": all_records[
-                f"{env.ALEO_STORE_PROGRAM_ID}/burn_private"
-            ][0],
             "fee_output_record": all_records[
                 f"{env.ALEO_CREDITS_PROGRAM_ID}/fee"
             ][0],
@@ -478,7 +587,7 @@ async def make_scan_burn(
         )
         return scan_burn_output
     except Exception as e:
-        await dynamodb_update(
+        dynamodb_buffered_update(
             env.ALEO_BURN_REQUESTS_TABLE,
             {"request_id": request_id},
             {"scan_mint_error": format_error(e)},
@@ -501,6 +610,7 @@ async def make_transfer_pp(
             pp_record,
             address,
             fee_record,
+            request_step=f"burn/{request_id}/transfer_pp",
         )
         transfer_pp_output = {"tx_id": tx_id}
         await dynamodb_update(
@@ -510,7 +620,7 @@ async def make_transfer_pp(
         )
         return transfer_pp_output
     except Exception as e:
-        await dynamodb_update(
+        dynamodb_buffered_update(
             env.ALEO_BURN_REQUESTS_TABLE,
             {"request_id": request_id},
             {"transfer_pp_error": format_error(e)},
@@ -521,7 +631,6 @@ async def make_transfer_pp(
 async def make_scan_transfer_pp(
     request_id,
     fee_output_record,
-    collection_output_record,
     transaction_id,
     scan_transfer_pp_output,
 ):
@@ -538,23 +647,25 @@ async def make_scan_transfer_pp(
                 f"{env.ALEO_CREDITS_PROGRAM_ID}/fee"
             ][0],
         }
-        await asyncio.gather(
-            dynamodb_update(
-                env.ALEO_BURN_REQUESTS_TABLE,
-                {"request_id": request_id},
-                {"scan_transfer_pp_output": scan_transfer_pp_output},
-            ),
-            push_treasury_records(
-                [
-                    (scan_transfer_pp_output["payment_output_record"], False),
-                    (fee_output_record, False),
-                    (collection_output_record, True),
-                ]
-            ),
+        dynamodb_buffered_update(
+            env.ALEO_BURN_REQUESTS_TABLE,
+            {"request_id": request_id},
+            {
+                "scan_transfer_pp_output": {"Value": scan_transfer_pp_output},
+                "request_status": {"Action": "DELETE"},
+            },
+            set_only=False,
         )
+        push_treasury_records(
+            [
+                (scan_transfer_pp_output["payment_output_record"], False),
+                (fee_output_record, False),
+            ]
+        )
+        await dynamodb_flush()
         return scan_transfer_pp_output
     except Exception as e:
-        await dynamodb_update(
+        dynamodb_buffered_update(
             env.ALEO_MINT_REQUESTS_TABLE,
             {"request_id": request_id},
             {"scan_transfer_pp_error": format_error(e)},
@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+from aleo import get_transaction_outputs, load_built_transaction
+from aws_utils import dynamodb_flush
+from confirmations import wait_for_confirmation
+from treasury import (
+    claim_treasury_records,
+    push_treasury_records,
+    select_collection_record,
+    load_treasury_operation,
+    return_treasury_operation,
+    finish_treasury_operation,
+)
+import env
+
+collection_lock = None
+collection_stats = {
+    "queued": 0,
+    "operations": 0,
+    "wait_time_s": 0.0,
+    "busy_time_s": 0.0,
+    "started_at": None,
+}
+
+
+def get_collection_lock():
+    global collection_lock
+    if collection_lock is None:
+        collection_lock = asyncio.Lock()
+        collection_stats["started_at"] = time.monotonic()
+    return collection_lock
+
+
+async def run_collection_operation(request_step, collection_output, operation):
+    lock = get_collection_lock()
+    queued_at = time.monotonic()
+    collection_stats["queued"] += 1
+    try:
+        await lock.acquire()
+    finally:
+        collection_stats["queued"] -= 1
+    started_at = time.monotonic()
+    collection_stats["wait_time_s"] += started_at - queued_at
+    try:
+        tx_id = await sequence_collection_operation(
+            request_step, collection_output, operation
+        )
+        collection_stats["operations"] += 1
+        return tx_id
+    finally:
+        collection_stats["busy_time_s"] += time.monotonic() - started_at
+        lock.release()
+
+
+async def sequence_collection_operation(
+    request_step, collection_output, operation
+):
+    claimed = await load_treasury_operation(request_step)
+    if claimed is not None:
+        (collection_record,) = claimed["records"]
+    elif await load_built_transaction(request_step) is not None:
+        return await operation(None)
+    else:
+        (collection_record,) = await claim_treasury_records(
+            select_collection_record, request_step
+        )
+
+    try:
+        tx_id = await operation(collection_record)
+    except Exception as e:
+        if await load_built_transaction(request_step) is None:
+            await return_treasury_operation(request_step)
+        raise e
+    try:
+        await wait_for_confirmation(tx_id)
+    except Exception as e:
+        if await load_built_transaction(request_step) is None:
+            await return_treasury_operation(request_step, rejected=True)
+        raise e
+
+    transition_id, output_index = collection_output
+    all_records = await get_transaction_outputs(
+        tx_id, env.MINT_ACCOUNT_VIEW_KEY
+    )
+    push_treasury_records([(all_records[transition_id][output_index], True)])
+    await dynamodb_flush()
+    await finish_treasury_operation(request_step)
+    return tx_id
+
+
+def collection_hold_s():
+    if collection_stats["operations"] == 0:
+        return None
+    return collection_stats["busy_time_s"] / collection_stats["operations"]
+
+
+def format_collection_stats():
+    if collection_stats["started_at"] is None:
+        return "collection sequencer idle"
+    elapsed_s = time.monotonic() - collection_stats["started_at"]
+    operations = collection_stats["operations"]
+    return (
+        f"collection sequencer: "
+        f"{collection_stats['busy_time_s'] / max(elapsed_s, 1e-9):.0%} "
+        f"utilisation, {collection_stats['queued']} queued, "
+        f"{operations} operations, avg wait "
+        f"{collection_stats['wait_time_s'] / max(operations, 1):.1f}s, "
+        f"avg hold "
+        f"{collection_stats['busy_time_s'] / max(operations, 1):.1f}s"
+    )
@@ -0,0 +1,115 @@
+import asyncio
+import env
+
+outstanding_transactions = {}
+transition_transactions = {}
+rejection_handlers = {}
+new_transaction_tracked = None
+
+
+def get_new_transaction_tracked():
+    global new_transaction_tracked
+    if new_transaction_tracked is None:
+        new_transaction_tracked = asyncio.Event()
+    return new_transaction_tracked
+
+
+def track_transaction(transaction, on_rejected=None):
+    if len(outstanding_transactions) > env.BUILT_TRANSACTIONS_CACHE_SIZE:
+        for tx_id, confirmation in list(outstanding_transactions.items()):
+            if confirmation.done():
+                forget_transaction(tx_id)
+
+    tx_id = transaction["id"]
+    if tx_id not in outstanding_transactions:
+        outstanding_transactions[tx_id] = (
+            asyncio.get_running_loop().create_future()
+        )
+    if on_rejected is not None:
+        rejection_handlers[tx_id] = on_rejected
+    for transition in transaction_transitions(transaction):
+        transition_transactions[transition["id"]] = tx_id
+    get_new_transaction_tracked().set()
+
+
+def forget_transaction(tx_id):
+    outstanding_transactions.pop(tx_id, None)
+    rejection_handlers.pop(tx_id, None)
+    for transition_id, transition_tx_id in list(
+        transition_transactions.items()
+    ):
+        if transition_tx_id == tx_id:
+            del transition_transactions[transition_id]
+
+
+def transaction_transitions(transaction):
+    execution = transaction.get("execution") or {}
+    fee = transaction.get("fee") or {}
+    return execution.get("transitions", []) + (
+        [fee["transition"]] if fee.get("transition") else []
+    )
+
+
+def resolve_transaction(tx_id, status):
+    confirmation = outstanding_transactions.get(tx_id)
+    if confirmation is not None and not confirmation.done():
+        confirmation.set_result(status)
+
+
+def note_block_transaction(confirmed_transaction):
+    status = confirmed_transaction.get("status")
+    transaction = confirmed_transaction.get("transaction") or {}
+    if status == "accepted":
+        resolve_transaction(transaction.get("id"), "accepted")
+        return
+    if status != "rejected":
+        return
+    rejected_execution = (confirmed_transaction.get("rejected") or {}).get(
+        "execution"
+    ) or {}
+    for transition in rejected_execution.get("transitions", []):
+        tx_id = transition_transactions.get(transition.get("id"))
+        if tx_id is not None:
+            resolve_transaction(tx_id, "rejected")
+    resolve_transaction(transaction.get("id"), "rejected")
+
+
+def has_pending_transactions():
+    return any(
+        not confirmation.done()
+        for confirmation in outstanding_transactions.values()
+    )
+
+
+async def wait_for_confirmation(tx_id):
+    confirmation = outstanding_transactions.get(tx_id)
+    if confirmation is None:
+        return
+    try:
+        status = await asyncio.wait_for(
+            asyncio.shield(confirmation), env.CONFIRMATION_TIMEOUT_S
+        )
+    except asyncio.TimeoutError:
+        forget_transaction(tx_id)
+        raise Exception(
+            f"Transaction {tx_id} not confirmed after "
+            f"{env.CONFIRMATION_TIMEOUT_S}s."
+        )
+    on_rejected = rejection_handlers.get(tx_id)
+    forget_transaction(tx_id)
+    if status == "rejected":
+        if on_rejected is not None:
+            await on_rejected()
+        raise Exception(f"Transaction {tx_id} was rejected.")
+
+
+async def wait_for_next_block_poll():
+    tracked = get_new_transaction_tracked()
+    if has_pending_transactions():
+        await asyncio.sleep(env.CONFIRMATION_POLL_PERIOD_S)
+        return
+    tracked.clear()
+    try:
+        await asyncio.wait_for(tracked.wait(), env.TRANSACTIONS_TASK_PERIOD_S)
+    except asyncio.TimeoutError:
+        pass
@@ -0,0 +1,84 @@
+import hashlib
+from aws_utils import dynamodb_get, dynamodb_delete, dynamodb_buffered_update
+import env
+
+FINGERPRINT_LENGTH = 16
+
+decrypt_misses = {}
+changed_view_fingerprints = set()
+
+fingerprint = lambda value: hashlib.sha256(value.encode()).hexdigest()[
+    :FINGERPRINT_LENGTH
+]
+
+height_bucket = lambda height: int(height) // env.DECRYPT_MISSES_BUCKET_SIZE
+
+
+async def load_decrypt_misses(view_key):
+    view_fingerprint = fingerprint(view_key)
+    if view_fingerprint in decrypt_misses:
+        return
+    memo = await dynamodb_get(
+        env.DECRYPT_MISSES_TABLE,
+        {"view_key_fingerprint": view_fingerprint},
+        projection_expression="misses",
+    )
+    misses = {}
+    for bucket, transaction_fingerprints in (
+        (memo or {}).get("misses", {}).items()
+    ):
+        for x in range(0, len(transaction_fingerprints), FINGERPRINT_LENGTH):
+            misses[transaction_fingerprints[x : x + FINGERPRINT_LENGTH]] = int(
+                bucket
+            )
+    decrypt_misses.setdefault(view_fingerprint, misses)
+
+
+def is_decrypt_miss(view_key, transaction_id):
+    return fingerprint(transaction_id) in decrypt_misses.get(
+        fingerprint(view_key), {}
+    )
+
+
+def add_decrypt_miss(view_key, transaction_id, discovery_height):
+    view_fingerprint = fingerprint(view_key)
+    decrypt_misses.setdefault(view_fingerprint, {})[
+        fingerprint(transaction_id)
+    ] = height_bucket(discovery_height)
+    changed_view_fingerprints.add(view_fingerprint)
+
+
+async def forget_decrypt_misses(view_key):
+    view_fingerprint = fingerprint(view_key)
+    decrypt_misses.pop(view_fingerprint, None)
+    changed_view_fingerprints.discard(view_fingerprint)
+    await dynamodb_delete(
+        env.DECRYPT_MISSES_TABLE,
+        {"view_key_fingerprint": view_fingerprint},
+    )
+
+
+def save_decrypt_misses(cur_height):
+    oldest_bucket = height_bucket(
+        max(cur_height - env.REQUESTS_SCAN_HEIGHT_LIMIT, 0)
+    )
+    for view_fingerprint in changed_view_fingerprints:
+        misses = decrypt_misses.get(view_fingerprint, {})
+        buckets = {}
+        for transaction_fingerprint, bucket in list(misses.items()):
+            if bucket < oldest_bucket:
+                del misses[transaction_fingerprint]
+                continue
+            buckets.setdefault(str(bucket), []).append(transaction_fingerprint)
+        dynamodb_buffered_update(
+            env.DECRYPT_MISSES_TABLE,
+            {"view_key_fingerprint": view_fingerprint},
+            {
+                "misses": {
+                    bucket: "".join(transaction_fingerprints)
+                    for bucket, transaction_fingerprints in buckets.items()
+                }
+            },
+            put=True,
+        )
+    changed_view_fingerprints.clear()
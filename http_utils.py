@@ -1,11 +1,77 @@
 import aiohttp
 import json
+import env
+
+aiohttp_session = None
+http_stats = {"connections_opened": 0, "connections_reused": 0}
+
+
+async def on_connection_create_end(session, context, params):
+    http_stats["connections_opened"] += 1
+
+
+async def on_connection_reuseconn(session, context, params):
+    http_stats["connections_reused"] += 1
+
+
+def get_aiohttp_session():
+    global aiohttp_session
+    if aiohttp_session is None or aiohttp_session.closed:
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        aiohttp_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=env.HTTP_POOL_SIZE,
+                limit_per_host=env.HTTP_POOL_SIZE_PER_HOST,
+                ttl_dns_cache=env.HTTP_DNS_CACHE_TTL_S,
+                keepalive_timeout=env.HTTP_KEEPALIVE_TIMEOUT_S,
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=env.HTTP_TIMEOUT_S,
+                connect=env.HTTP_CONNECT_TIMEOUT_S,
+            ),
+            trace_configs=[trace_config],
+        )
+    return aiohttp_session
+
+
+async def close_aiohttp_session():
+    global aiohttp_session
+    if aiohttp_session is not None:
+        await aiohttp_session.close()
+        aiohttp_session = None
+
+
+def format_http_stats():
+    return (
+        f"{http_stats['connections_opened']} opened, "
+        f"{http_stats['connections_reused']} reused"
+    )
 
 
 async def get_request(url, headers=None, json_output=True):
-    async with aiohttp.ClientSession() as aiohttp_session:
-        async with aiohttp_session.get(url, headers=headers) as response:
-            rep = await response.text()
-            if json_output:
-                rep = json.loads(rep)
-            return rep
+    async with get_aiohttp_session().get(url, headers=headers) as response:
+        rep = await response.read()
+        if json_output:
+            return json.loads(rep)
+        return rep.decode()
+
+
+class HttpStatusError(Exception):
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+async def post_request(url, json_body, headers=None):
+    async with get_aiohttp_session().post(
+        url, json=json_body, headers=headers
+    ) as response:
+        rep = (await response.read()).decode()
+        if response.status >= 400:
+            raise HttpStatusError(
+                f"POST {url} returned {response.status}: {rep}",
+                response.status,
+            )
+        return rep
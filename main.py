@@ -4,11 +4,13 @@ from mint import (
     get_mint_requests,
     handle_active_mint_request,
     mint_scan_records,
+    save_mint_scan_pp_output,
 )
 from burn import (
     get_burn_requests,
     handle_active_burn_request,
     burn_scan_records,
+    save_burn_scan_pp_output,
 )
 from aleo import (
     get_height,
@@ -16,10 +18,39 @@ from aleo import (
     get_transaction_id,
     get_transaction,
     get_block_transactions,
+    decrypt_records,
 )
 import random
 
-from aws_utils import dynamodb_get, dynamodb_update, dynamodb_scan
+from aws_utils import (
+    dynamodb_get,
+    dynamodb_update,
+    dynamodb_buffered_update,
+    dynamodb_flush,
+    dynamodb_scan_pages,
+    open_dynamodb_clients,
+    close_dynamodb_clients,
+    dynamodb_stats,
+)
+from http_utils import close_aiohttp_session, format_http_stats
+from decrypt_memo import (
+    load_decrypt_misses,
+    is_decrypt_miss,
+    add_decrypt_miss,
+    save_decrypt_misses,
+)
+from warmup import warmup
+from treasury import format_treasury_stats
+from rebalancer import rebalance_treasury, format_rebalance_stats
+from collection_sequencer import format_collection_stats
+from admission import queue_requests, admit_requests, format_admission_stats
+from confirmations import note_block_transaction, wait_for_next_block_poll
+from snarkos_pool import close_snarkos_pool, format_snarkos_pool_stats
+from snarkos_scheduler import (
+    snarkos_priority,
+    PRIORITY_SCAN,
+    format_snarkos_scheduler_stats,
+)
 
 import env
 import traceback
@@ -50,6 +81,10 @@ def merge_requests(burn_requests, mint_requests):
 
 
 in_progress = False
+pending_requests = {"mint": {}, "burn": {}}
+request_workers = None
+request_tasks = {}
+waiting_for_worker = set()
 
 
 async def sync():
@@ -60,33 +95,24 @@ async def sync():
     try:
         cur_height = await get_height()
         await create_accounts_if_needed()
-        [
-            mint_requests,
-            burn_requests,
-            mint_transfer_transactions,
-            burn_transfer_transactions,
-        ] = await asyncio.gather(
+        mint_requests, burn_requests = await asyncio.gather(
             get_mint_requests(cur_height),
             get_burn_requests(cur_height),
-            get_recent_transfer_transactions_mint(cur_height),
-            get_recent_transfer_transactions_burn(cur_height),
         )
+        register_pending_requests("mint", mint_requests)
+        register_pending_requests("burn", burn_requests)
         await asyncio.gather(
-            asyncio.gather(
-                *[
-                    mint_scan_records(
-                        request, cur_height, mint_transfer_transactions
-                    )
-                    for request in mint_requests
-                ],
+            scan_transfer_pages(
+                mint_requests,
+                mint_scan_records,
+                cur_height,
+                get_recent_transfer_transactions_mint(cur_height),
             ),
-            asyncio.gather(
-                *[
-                    burn_scan_records(
-                        request, cur_height, burn_transfer_transactions
-                    )
-                    for request in burn_requests
-                ],
+            scan_transfer_pages(
+                burn_requests,
+                burn_scan_records,
+                cur_height,
+                get_recent_transfer_transactions_burn(cur_height),
             ),
         )
         mint_requests = [
@@ -99,23 +125,116 @@ async def sync():
             for burn_request in burn_requests
             if burn_request.get("scan_pp_output") is not None
         ]
+        save_decrypt_misses(cur_height)
+        print(format_snarkos_pool_stats())
+        print(format_snarkos_scheduler_stats())
+        print(format_treasury_stats())
+        print(format_rebalance_stats())
+        print(format_collection_stats())
         requests = merge_requests(burn_requests, mint_requests)
-        for request in requests:
-            try:
-                if request["type"] == "mint":
-                    await handle_active_mint_request(request, cur_height)
-                else:
-                    await handle_active_burn_request(request, cur_height)
-            except Exception as e:
-                print(format_error(e))
+        await start_request_workers(requests, cur_height)
+        print(f"{len(request_tasks)} requests in progress")
+        print(format_admission_stats(len(request_tasks)))
         in_progress = False
     except Exception as e:
         in_progress = False
         print(traceback.format_exc())
 
 
-async def get_recent_transfer_transactions_mint(cur_height):
-    return await dynamodb_scan(
+def get_request_workers():
+    global request_workers
+    if request_workers is None:
+        request_workers = asyncio.Semaphore(env.REQUEST_WORKERS)
+    return request_workers
+
+
+async def start_request_workers(requests, cur_height):
+    new_requests = []
+    for request in requests:
+        request_key = (request["type"], request["request_id"])
+        if request_key in request_tasks:
+            continue
+        if request.get("scan_former_output"):
+            start_request_worker(request_key, request, cur_height)
+        else:
+            new_requests.append((request_key, request))
+
+    queue_requests(new_requests)
+    for request_key, request in await admit_requests(
+        len(request_tasks), len(waiting_for_worker)
+    ):
+        waiting_for_worker.add(request_key)
+        start_request_worker(request_key, request, cur_height)
+
+
+def start_request_worker(request_key, request, cur_height):
+    request_tasks[request_key] = asyncio.ensure_future(
+        handle_request(request_key, request, cur_height)
+    )
+
+
+async def handle_request(request_key, request, cur_height):
+    try:
+        async with get_request_workers():
+            waiting_for_worker.discard(request_key)
+            if request["type"] == "mint":
+                await handle_active_mint_request(request, cur_height)
+            else:
+                await handle_active_burn_request(request, cur_height)
+    except Exception as e:
+        print(format_error(e))
+    finally:
+        waiting_for_worker.discard(request_key)
+        request_tasks.pop(request_key, None)
+
+
+async def close_request_workers():
+    tasks = list(request_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def register_pending_requests(request_type, requests):
+    pending_requests[request_type] = {
+        request["request_id"]: request
+        for request in requests
+        if request.get("scan_pp_output") is None
+    }
+
+
+async def scan_transfer_pages(
+    requests, scan_records, cur_height, transfer_pages
+):
+    scan_tasks = {}
+    try:
+        async for transfer_transactions in transfer_pages:
+            for request in requests:
+                scan_tasks[request["request_id"]] = asyncio.ensure_future(
+                    scan_records_after(
+                        scan_tasks.get(request["request_id"]),
+                        scan_records,
+                        request,
+                        cur_height,
+                        transfer_transactions,
+                    )
+                )
+    finally:
+        await asyncio.gather(*scan_tasks.values())
+
+
+async def scan_records_after(
+    previous_task, scan_records, request, cur_height, transfer_transactions
+):
+    snarkos_priority.set(PRIORITY_SCAN)
+    if previous_task is not None:
+        await previous_task
+    if request.get("scan_pp_output") is None:
+        await scan_records(request, cur_height, transfer_transactions)
+
+
+def get_recent_transfer_transactions_mint(cur_height):
+    return dynamodb_scan_pages(
         env.KNOWN_TRANSACTION_IDS_TABLE,
         filter_expression="discovery_height >= :height_limit and attribute_not_exists(used_already)",
         ExpressionAttributeValues={
@@ -123,11 +242,13 @@ async def get_recent_transfer_transactions_mint(cur_height):
                 "N": str(cur_height - env.REQUESTS_SCAN_HEIGHT_LIMIT)
             }
         },
+        projection_expression="transaction_id, encrypted_record, discovery_height",
+        segments=env.KNOWN_TRANSACTIONS_SCAN_SEGMENTS,
     )
 
 
-async def get_recent_transfer_transactions_burn(cur_height):
-    return await dynamodb_scan(
+def get_recent_transfer_transactions_burn(cur_height):
+    return dynamodb_scan_pages(
         env.KNOWN_BURN_TRANSACTION_IDS_TABLE,
         filter_expression="discovery_height >= :height_limit and attribute_not_exists(used_already)",
         ExpressionAttributeValues={
@@ -135,14 +256,30 @@ async def get_recent_transfer_transactions_burn(cur_height):
                 "N": str(cur_height - env.REQUESTS_SCAN_HEIGHT_LIMIT)
             }
         },
+        projection_expression="transaction_id, encrypted_record, discovery_height",
+        segments=env.KNOWN_TRANSACTIONS_SCAN_SEGMENTS,
     )
 
 
 async def periodic():
-    await asyncio.gather(periodic_transactions(), periodic_sync())
+    await open_dynamodb_clients()
+    try:
+        await asyncio.gather(
+            periodic_transactions(), periodic_sync(), periodic_rebalance()
+        )
+    finally:
+        await close_request_workers()
+        await dynamodb_flush()
+        await asyncio.gather(
+            close_aiohttp_session(),
+            close_dynamodb_clients(),
+            close_snarkos_pool(),
+        )
 
 
 async def periodic_sync():
+    if env.WARMUP_ON_START:
+        await warmup()
     while True:
         try:
             await sync()
@@ -151,19 +288,31 @@ async def periodic_sync():
         await asyncio.sleep(env.SYNC_TASK_PERIOD_S)
 
 
+async def periodic_rebalance():
+    while True:
+        await asyncio.sleep(env.TREASURY_REBALANCE_PERIOD_S)
+        if request_tasks:
+            continue
+        try:
+            await rebalance_treasury()
+        except Exception as e:
+            print(format_error(e))
+
+
 async def periodic_transactions():
     while True:
         try:
             await sync_transactions()
         except Exception as e:
             print(format_error(e))
-        await asyncio.sleep(env.TRANSACTIONS_TASK_PERIOD_S)
+        await wait_for_next_block_poll()
 
 
 async def sync_block(height):
     transactions = await get_block_transactions(height)
     to_execute = []
     for transaction in transactions:
+        note_block_transaction(transaction)
         if (
             transaction.get("status") != "accepted"
             or transaction.get("type") != "execute"
@@ -195,9 +344,11 @@ async def sync_transition(transaction_id, transition, height):
     if program_id == env.PRIVACY_PRIDE_PROGRAM_ID:
         known_transaction_ids_table = env.KNOWN_TRANSACTION_IDS_TABLE
         function_name = "transfer_private"
+        request_type = "mint"
     elif program_id == env.ALEO_STORE_PROGRAM_ID:
         known_transaction_ids_table = env.KNOWN_BURN_TRANSACTION_IDS_TABLE
         function_name = "transfer_token_private"
+        request_type = "burn"
     else:
         return
 
@@ -209,7 +360,7 @@ async def sync_transition(transaction_id, transition, height):
         return
     encrypted_record = outputs[0].get("value")
 
-    await dynamodb_update(
+    dynamodb_buffered_update(
         known_transaction_ids_table,
         {"transaction_id": transaction_id},
         {
@@ -217,36 +368,131 @@ async def sync_transition(transaction_id, transition, height):
             "discovery_height": height,
         },
     )
+    await match_transfer(
+        request_type, transaction_id, encrypted_record, height
+    )
+
+
+async def match_transfer(
+    request_type, transaction_id, encrypted_record, height
+):
+    requests = [
+        request
+        for request in pending_requests[request_type].values()
+        if request.get("scan_pp_output") is None
+    ]
+    await asyncio.gather(
+        *[
+            load_decrypt_misses(request["recipient_view_key"])
+            for request in requests
+        ]
+    )
+    requests = [
+        request
+        for request in requests
+        if not is_decrypt_miss(request["recipient_view_key"], transaction_id)
+    ]
+    records = await decrypt_records(
+        [
+            (encrypted_record, request["recipient_view_key"])
+            for request in requests
+        ]
+    )
+    for request, record in zip(requests, records):
+        if record == "":
+            add_decrypt_miss(
+                request["recipient_view_key"], transaction_id, height
+            )
+        if not record or request.get("scan_pp_output") is not None:
+            continue
+        if request_type == "mint":
+            save_scan_pp_output = save_mint_scan_pp_output
+        else:
+            save_scan_pp_output = save_burn_scan_pp_output
+        try:
+            request["scan_pp_output"] = await save_scan_pp_output(
+                request["request_id"],
+                request["recipient_view_key"],
+                transaction_id,
+                record,
+            )
+        except Exception as e:
+            print(format_error(e))
+        pending_requests[request_type].pop(request["request_id"], None)
 
 
 async def sync_transactions():
+    snarkos_priority.set(PRIORITY_SCAN)
     cur_height = await get_height()
     last_known_block = (
         await dynamodb_get(
             env.KNOWN_BLOCKS_TABLE,
             {"block_height": 0},
+            projection_expression="block_height_value",
         )
     )["block_height_value"]
 
-    new_last_known_block = last_known_block
+    blocks_to_ignore = env.BLOCKS_TO_IGNORE.split(",")
+    next_block = last_known_block + 1
+    committed_block = last_known_block
+    contiguous_block = last_known_block
+    completed_blocks = set()
+    in_flight = {}
+    failed = False
 
-    while new_last_known_block <= cur_height:
-        try:
-            new_last_known_block += 1
-            if new_last_known_block in env.BLOCKS_TO_IGNORE.split(","):
-                continue
-            await sync_block(new_last_known_block)
-        except Exception as e:
-            new_last_known_block -= 1
-            print(format_error(e))
+    while True:
+        while (
+            not failed
+            and len(in_flight) < env.TRANSACTIONS_SYNC_WINDOW
+            and next_block <= cur_height
+        ):
+            if str(next_block) in blocks_to_ignore:
+                completed_blocks.add(next_block)
+            else:
+                task = asyncio.ensure_future(sync_block(next_block))
+                in_flight[task] = next_block
+            next_block += 1
+
+        if in_flight:
+            done, _ = await asyncio.wait(
+                in_flight, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                height = in_flight.pop(task)
+                if task.exception() is not None:
+                    failed = True
+                    print(format_error(task.exception()))
+                    continue
+                completed_blocks.add(height)
+
+        while contiguous_block + 1 in completed_blocks:
+            contiguous_block += 1
+            completed_blocks.remove(contiguous_block)
+
+        if not in_flight and (failed or next_block > cur_height):
             break
 
-    if new_last_known_block != last_known_block:
-        await dynamodb_update(
-            env.KNOWN_BLOCKS_TABLE,
-            {"block_height": 0},
-            {"block_height_value": new_last_known_block},
-        )
+        if contiguous_block - committed_block >= env.TRANSACTIONS_SYNC_WINDOW:
+            await commit_last_known_block(contiguous_block)
+            committed_block = contiguous_block
+
+    if contiguous_block != committed_block:
+        await commit_last_known_block(contiguous_block)
+
+    print(
+        f"Synced blocks {last_known_block + 1} to {contiguous_block}, "
+        f"connections: {format_http_stats()}, "
+        f"dynamodb clients created: {dynamodb_stats['clients_created']}"
+    )
+
+
+async def commit_last_known_block(height):
+    await dynamodb_flush()
+    await dynamodb_update(
+        env.KNOWN_BLOCKS_TABLE,
+        {"block_height": 0},
+        {"block_height_value": height},
+    )
 
 
 if __name__ == "__main__":
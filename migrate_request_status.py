@@ -0,0 +1,96 @@
+import asyncio
+from aws_utils import (
+    get_dynamodb_client,
+    close_dynamodb_clients,
+    dynamodb_scan,
+    dynamodb_update,
+)
+import env
+
+
+def get_request_status(request, done_attribute):
+    if request.get(done_attribute) is not None or request.get("not_possible"):
+        return None
+    if request.get("scan_pp_output") is not None:
+        return "active"
+    return "pending"
+
+
+async def create_request_status_index(table_name):
+    dynamodb_client = await get_dynamodb_client()
+    table = (await dynamodb_client.describe_table(TableName=table_name))[
+        "Table"
+    ]
+    index_names = [
+        index["IndexName"] for index in table.get("GlobalSecondaryIndexes", [])
+    ]
+    if env.REQUESTS_STATUS_INDEX in index_names:
+        return
+    await dynamodb_client.update_table(
+        TableName=table_name,
+        AttributeDefinitions=[
+            {"AttributeName": "request_status", "AttributeType": "S"},
+            {"AttributeName": "creation_block_height", "AttributeType": "N"},
+        ],
+        GlobalSecondaryIndexUpdates=[
+            {
+                "Create": {
+                    "IndexName": env.REQUESTS_STATUS_INDEX,
+                    "KeySchema": [
+                        {"AttributeName": "request_status", "KeyType": "HASH"},
+                        {
+                            "AttributeName": "creation_block_height",
+                            "KeyType": "RANGE",
+                        },
+                    ],
+                    "Projection": {"ProjectionType": "ALL"},
+                }
+            }
+        ],
+    )
+    print("Index creation started on", table_name)
+
+
+async def backfill_request_status(table_name, done_attribute):
+    requests = await dynamodb_scan(table_name)
+    updates = []
+    for request in requests:
+        request_status = get_request_status(request, done_attribute)
+        if request_status == request.get("request_status"):
+            continue
+        if request_status is None:
+            changes = {"request_status": {"Action": "DELETE"}}
+        else:
+            changes = {"request_status": {"Value": request_status}}
+        updates.append(
+            dynamodb_update(
+                table_name,
+                {"request_id": request["request_id"]},
+                changes,
+                set_only=False,
+            )
+        )
+    await asyncio.gather(*updates)
+    print(f"{len(updates)}/{len(requests)} requests updated in", table_name)
+
+
+async def migrate():
+    try:
+        await asyncio.gather(
+            create_request_status_index(env.ALEO_MINT_REQUESTS_TABLE),
+            create_request_status_index(env.ALEO_BURN_REQUESTS_TABLE),
+        )
+        await asyncio.gather(
+            backfill_request_status(
+                env.ALEO_MINT_REQUESTS_TABLE, "scan_mint_output"
+            ),
+            backfill_request_status(
+                env.ALEO_BURN_REQUESTS_TABLE, "scan_transfer_pp_output"
+            ),
+        )
+    finally:
+        await close_dynamodb_clients()
+
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
@@ -1,16 +1,30 @@
 import asyncio
-from aws_utils import dynamodb_update, dynamodb_scan
+from aws_utils import (
+    dynamodb_update,
+    dynamodb_buffered_update,
+    dynamodb_flush,
+    dynamodb_count,
+    dynamodb_query,
+)
 from aleo import (
     create_account,
     transfer_credits,
     get_transaction_outputs,
-    get_treasury_records,
-    push_treasury_records,
-    decrypt_record,
+    decrypt_records_until_match,
     transfer_pp,
     mint_private,
     encode_string64,
 )
+from confirmations import wait_for_confirmation
+from step_graph import run_step_graph
+from treasury import allocate_treasury_records, push_treasury_records
+from collection_sequencer import run_collection_operation
+from decrypt_memo import (
+    load_decrypt_misses,
+    is_decrypt_miss,
+    add_decrypt_miss,
+    forget_decrypt_misses,
+)
 import env
 from project_utils import record_to_amount, format_error, record_to_pp_data
 
@@ -28,8 +42,8 @@ async def create_and_store_account():
 
 
 async def create_accounts_if_needed():
-    addresses = await dynamodb_scan(env.ALEO_ADDRESSES_TABLE)
-    addresses_to_create = env.WANTED_ADDRESSES - len(addresses)
+    addresses_count = await dynamodb_count(env.ALEO_ADDRESSES_TABLE)
+    addresses_to_create = env.WANTED_ADDRESSES - addresses_count
 
     if addresses_to_create <= 0:
         return
@@ -41,12 +55,24 @@ async def create_accounts_if_needed():
 
 async def get_mint_requests(cur_height):
     height_limit = cur_height - env.REQUESTS_SCAN_HEIGHT_LIMIT
-    requests = await dynamodb_scan(
-        env.ALEO_MINT_REQUESTS_TABLE,
-        filter_expression=f"(creation_block_height >= :height_limit or attribute_exists(scan_pp_output)) and attribute_not_exists(scan_mint_output) and attribute_not_exists(not_possible)",
-        ExpressionAttributeValues={":height_limit": {"N": str(height_limit)}},
+    pending_requests, active_requests = await asyncio.gather(
+        dynamodb_query(
+            env.ALEO_MINT_REQUESTS_TABLE,
+            "request_status = :pending and creation_block_height >= :height_limit",
+            index_name=env.REQUESTS_STATUS_INDEX,
+            ExpressionAttributeValues={
+                ":pending": {"S": "pending"},
+                ":height_limit": {"N": str(height_limit)},
+            },
+        ),
+        dynamodb_query(
+            env.ALEO_MINT_REQUESTS_TABLE,
+            "request_status = :active",
+            index_name=env.REQUESTS_STATUS_INDEX,
+            ExpressionAttributeValues={":active": {"S": "active"}},
+        ),
     )
-    return requests
+    return pending_requests + active_requests
 
 
 async def mint_scan_records(request, cur_height, mint_transfer_transactions):
@@ -87,77 +113,113 @@ async def handle_active_mint_request(request, cur_height):
     mint_output = request.get("mint_output", None)
     scan_mint_output = request.get("scan_mint_output", None)
 
-    try:
-        scan_former_output = await make_scan_former(
-            request_id, scan_former_output
-        )
-        has_worked = not bool(transfer_credits_fees_output)
-        transfer_credits_fees_output = await make_transfer_credits_fees(
-            request_id,
-            recipient_address,
-            scan_former_output["payment_record"],
-            scan_former_output["fee_record"],
-            transfer_credits_fees_output,
-        )
-        if has_worked:
-            await asyncio.sleep(15)
-        scan_transfer_credits_fees_output = (
-            await make_scan_transfer_credits_fees(
+    steps = {
+        "scan_former_output": (
+            [],
+            lambda outputs: make_scan_former(request_id, scan_former_output),
+        ),
+        "transfer_credits_fees_output": (
+            ["scan_former_output"],
+            lambda outputs: make_transfer_credits_fees(
+                request_id,
+                recipient_address,
+                outputs["scan_former_output"]["payment_record"],
+                outputs["scan_former_output"]["fee_record"],
+                transfer_credits_fees_output,
+            ),
+        ),
+        "scan_transfer_credits_fees_output": (
+            ["transfer_credits_fees_output"],
+            lambda outputs: make_scan_transfer_credits_fees(
                 request_id,
-                transfer_credits_fees_output["tx_id"],
+                outputs["transfer_credits_fees_output"]["tx_id"],
                 recipient_view_key,
                 scan_transfer_credits_fees_output,
-            )
-        )
-        has_worked = not bool(transfer_pp_output)
-        transfer_pp_output = await make_transfer_pp(
-            request_id,
-            recipient_private_key,
-            scan_pp_output["received_record"],
-            scan_transfer_credits_fees_output["transfer_output_record"],
-            transfer_pp_output,
-        )
-        if has_worked:
-            await asyncio.sleep(15)
-        scan_transfer_pp_output = await make_scan_transfer_pp(
-            request_id,
-            scan_pp_output["pp_data"]["token_number"],
-            transfer_pp_output["tx_id"],
-            scan_transfer_pp_output,
-        )
-        has_worked = not bool(mint_output)
-        mint_output = await make_mint(
-            request_id,
-            scan_former_output["collection_record"],
-            scan_pp_output["pp_data"],
-            user_address,
-            scan_transfer_credits_fees_output["payment_output_record"],
-            mint_output,
-        )
-        if has_worked:
-            await asyncio.sleep(15)
-
-        scan_mint_output = await make_scan_mint(
-            request_id,
-            mint_output["tx_id"],
-            scan_transfer_credits_fees_output["fee_output_record"],
-            scan_mint_output,
-        )
+            ),
+        ),
+        "transfer_credits_fees_confirmed": (
+            ["transfer_credits_fees_output"],
+            lambda outputs: wait_for_confirmation(
+                outputs["transfer_credits_fees_output"]["tx_id"]
+            ),
+        ),
+        "transfer_pp_output": (
+            [
+                "scan_transfer_credits_fees_output",
+                "transfer_credits_fees_confirmed",
+            ],
+            lambda outputs: make_transfer_pp(
+                request_id,
+                recipient_private_key,
+                scan_pp_output["received_record"],
+                outputs["scan_transfer_credits_fees_output"][
+                    "transfer_output_record"
+                ],
+                transfer_pp_output,
+            ),
+        ),
+        "transfer_pp_confirmed": (
+            ["transfer_pp_output"],
+            lambda outputs: wait_for_confirmation(
+                outputs["transfer_pp_output"]["tx_id"]
+            ),
+        ),
+        "scan_transfer_pp_output": (
+            ["transfer_pp_output", "transfer_pp_confirmed"],
+            lambda outputs: make_scan_transfer_pp(
+                request_id,
+                scan_pp_output["pp_data"]["token_number"],
+                outputs["transfer_pp_output"]["tx_id"],
+                scan_transfer_pp_output,
+            ),
+        ),
+        "mint_output": (
+            [
+                "scan_transfer_credits_fees_output",
+                "transfer_credits_fees_confirmed",
+            ],
+            lambda outputs: make_mint(
+                request_id,
+                scan_pp_output["pp_data"],
+                user_address,
+                outputs["scan_transfer_credits_fees_output"][
+                    "payment_output_record"
+                ],
+                mint_output,
+            ),
+        ),
+        "mint_confirmed": (
+            ["mint_output"],
+            lambda outputs: wait_for_confirmation(
+                outputs["mint_output"]["tx_id"]
+            ),
+        ),
+        "scan_mint_output": (
+            [
+                "scan_transfer_credits_fees_output",
+                "transfer_pp_confirmed",
+                "scan_transfer_pp_output",
+                "mint_output",
+                "mint_confirmed",
+            ],
+            lambda outputs: make_scan_mint(
+                request_id,
+                outputs["mint_output"]["tx_id"],
+                outputs["scan_transfer_credits_fees_output"][
+                    "fee_output_record"
+                ],
+                scan_mint_output,
+            ),
+        ),
+    }
 
+    try:
+        await run_step_graph(steps)
     except Exception as e:
         print(format_error(e))
         return
 
 
-async def decrypt_transaction_record(transaction, recipient_view_key):
-    return {
-        "transaction_id": transaction["transaction_id"],
-        "record": await decrypt_record(
-            transaction["encrypted_record"], recipient_view_key
-        ),
-    }
-
-
 async def make_scan_credits(
     request_id,
     recipient_view_key,
@@ -169,19 +231,50 @@ async def make_scan_credits(
     if scan_pp_output:
         return scan_pp_output
 
-    decrypted = await asyncio.gather(
-        *[
-            decrypt_transaction_record(transaction, recipient_view_key)
+    await load_decrypt_misses(recipient_view_key)
+    mint_transfer_transactions = sorted(
+        [
+            transaction
+            for transaction in mint_transfer_transactions
+            if transaction["discovery_height"] >= creation_block_height
+            and not is_decrypt_miss(
+                recipient_view_key, transaction["transaction_id"]
+            )
+        ],
+        key=lambda transaction: transaction["discovery_height"],
+    )
+    records = await decrypt_records_until_match(
+        [
+            (transaction["encrypted_record"], recipient_view_key)
             for transaction in mint_transfer_transactions
         ]
     )
-    decrypted = [dec for dec in decrypted if dec["record"]]
+    for transaction, record in zip(mint_transfer_transactions, records):
+        if record == "":
+            add_decrypt_miss(
+                recipient_view_key,
+                transaction["transaction_id"],
+                transaction["discovery_height"],
+            )
+    decrypted = [
+        {"transaction_id": transaction["transaction_id"], "record": record}
+        for transaction, record in zip(mint_transfer_transactions, records)
+        if record
+    ]
     if len(decrypted) == 0:
         raise Exception("No records found.")
 
-    received_record = decrypted[0]["record"]
-    transaction_id = decrypted[0]["transaction_id"]
+    return await save_mint_scan_pp_output(
+        request_id,
+        recipient_view_key,
+        decrypted[0]["transaction_id"],
+        decrypted[0]["record"],
+    )
+
 
+async def save_mint_scan_pp_output(
+    request_id, recipient_view_key, transaction_id, received_record
+):
     pp_data = record_to_pp_data(received_record)
 
     scan_pp_output = {
@@ -189,17 +282,18 @@ async def make_scan_credits(
         "received_record": received_record,
         "transaction_id": transaction_id,
     }
+    dynamodb_buffered_update(
+        env.ALEO_MINT_REQUESTS_TABLE,
+        {"request_id": request_id},
+        {"scan_pp_output": scan_pp_output, "request_status": "active"},
+    )
+    dynamodb_buffered_update(
+        env.KNOWN_TRANSACTION_IDS_TABLE,
+        {"transaction_id": transaction_id},
+        {"used_already": True},
+    )
     await asyncio.gather(
-        dynamodb_update(
-            env.ALEO_MINT_REQUESTS_TABLE,
-            {"request_id": request_id},
-            {"scan_pp_output": scan_pp_output},
-        ),
-        dynamodb_update(
-            env.KNOWN_TRANSACTION_IDS_TABLE,
-            {"transaction_id": transaction_id},
-            {"used_already": True},
-        ),
+        dynamodb_flush(), forget_decrypt_misses(recipient_view_key)
     )
     return scan_pp_output
 
@@ -211,16 +305,11 @@ async def make_scan_former(
     if scan_former_output:
         return scan_former_output
     try:
-        (
-            payment_record,
-            fee_record,
-            collection_record,
-        ) = await get_treasury_records()
+        payment_record, fee_record = await allocate_treasury_records()
 
         scan_former_output = {
             "payment_record": payment_record,
             "fee_record": fee_record,
-            "collection_record": collection_record,
         }
         await dynamodb_update(
             env.ALEO_MINT_REQUESTS_TABLE,
@@ -229,7 +318,7 @@ async def make_scan_former(
         )
         return scan_former_output
     except Exception as e:
-        await dynamodb_update(
+        dynamodb_buffered_update(
             env.ALEO_MINT_REQUESTS_TABLE,
             {"request_id": request_id},
             {"scan_scan_former_error": format_error(e)},
@@ -253,6 +342,7 @@ async def make_transfer_credits_fees(
             env.TRANSFER_LEOS_FEE,
             amount_record,
             fee_record,
+            request_step=f"mint/{request_id}/transfer_credits_fees",
         )
         transfer_credits_fees_output = {"tx_id": tx_id}
         await dynamodb_update(
@@ -262,7 +352,7 @@ async def make_transfer_credits_fees(
         )
         return transfer_credits_fees_output
     except Exception as e:
-        await dynamodb_update(
+        dynamodb_buffered_update(
             env.ALEO_MINT_REQUESTS_TABLE,
             {"request_id": request_id},
             {"transfer_credits_fees_error": format_error(e)},
@@ -308,7 +398,7 @@ async def make_scan_transfer_credits_fees(
         )
         return scan_transfer_credits_fees_output
     except Exception as e:
-        await dynamodb_update(
+        dynamodb_buffered_update(
             env.ALEO_MINT_REQUESTS_TABLE,
             {"request_id": request_id},
             {"scan_transfer_credits_fees_error": format_error(e)},
@@ -331,6 +421,7 @@ async def make_transfer_pp(
             leo_record,
             env.MINT_ACCOUNT_ADDRESS,
             fee_record,
+            request_step=f"mint/{request_id}/transfer_pp",
         )
         transfer_pp_output = {"tx_id": tx_id}
         await dynamodb_update(
@@ -340,7 +431,7 @@ async def make_transfer_pp(
         )
         return transfer_pp_output
     except Exception as e:
-        await dynamodb_update(
+        dynamodb_buffered_update(
             env.ALEO_MINT_REQUESTS_TABLE,
             {"request_id": request_id},
             {"transfer_pp_error": format_error(e)},
@@ -367,21 +458,20 @@ async def make_scan_transfer_pp(
                 f"{env.PRIVACY_PRIDE_PROGRAM_ID}/transfer_private"
             ][0],
         }
-        await asyncio.gather(
-            dynamodb_update(
-                env.ALEO_MINT_REQUESTS_TABLE,
-                {"request_id": request_id},
-                {"scan_transfer_pp_output": scan_transfer_pp_output},
-            ),
-            dynamodb_update(
-                env.PRIVACY_PRIDE_STORED_TOKEN_RECORDS_TABLE,
-                {"token_number": token_number},
-                {"token_record": scan_transfer_pp_output["pp_record"]},
-            ),
+        dynamodb_buffered_update(
+            env.ALEO_MINT_REQUESTS_TABLE,
+            {"request_id": request_id},
+            {"scan_transfer_pp_output": scan_transfer_pp_output},
+        )
+        dynamodb_buffered_update(
+            env.PRIVACY_PRIDE_STORED_TOKEN_RECORDS_TABLE,
+            {"token_number": token_number},
+            {"token_record": scan_transfer_pp_output["pp_record"]},
         )
+        await dynamodb_flush()
         return scan_transfer_pp_output
     except Exception as e:
-        await dynamodb_update(
+        dynamodb_buffered_update(
             env.ALEO_MINT_REQUESTS_TABLE,
             {"request_id": request_id},
             {"scan_transfer_pp_error": format_error(e)},
@@ -391,7 +481,6 @@ async def make_scan_transfer_pp(
 
 async def make_mint(
     request_id,
-    collection_record,
     pp_data,
     user_address,
     fee_record,
@@ -400,13 +489,19 @@ async def make_mint(
     if mint_output:
         return mint_output
     try:
-        tx_id = await mint_private(
-            env.MINT_ACCOUNT_PRIVATE_KEY,
-            collection_record,
-            pp_data["token_number"],
-            user_address,
-            encode_string64(str(pp_data["token_id"]) + ".json"),
-            fee_record,
+        request_step = f"mint/{request_id}/mint"
+        tx_id = await run_collection_operation(
+            request_step,
+            (f"{env.ALEO_STORE_PROGRAM_ID}/mint_private", 1),
+            lambda collection_record: mint_private(
+                env.MINT_ACCOUNT_PRIVATE_KEY,
+                collection_record,
+                pp_data["token_number"],
+                user_address,
+                encode_string64(str(pp_data["token_id"]) + ".json"),
+                fee_record,
+                request_step=request_step,
+            ),
         )
         mint_output = {"tx_id": tx_id}
         await dynamodb_update(
@@ -416,7 +511,7 @@ async def make_mint(
         )
         return mint_output
     except Exception as e:
-        await dynamodb_update(
+        dynamodb_buffered_update(
             env.ALEO_MINT_REQUESTS_TABLE,
             {"request_id": request_id},
             {"mint_error": format_error(e)},
@@ -439,32 +534,31 @@ async def make_scan_mint(
         )
 
         scan_mint_output = {
-            "collection_output_record": all_records[
-                f"{env.ALEO_STORE_PROGRAM_ID}/mint_private"
-            ][1],
             "payment_output_record": to_store_record,
             "fee_output_record": all_records[
                 f"{env.ALEO_CREDITS_PROGRAM_ID}/fee"
             ][0],
         }
 
-        await asyncio.gather(
-            dynamodb_update(
-                env.ALEO_MINT_REQUESTS_TABLE,
-                {"request_id": request_id},
-                {"scan_mint_output": scan_mint_output},
-            ),
-            push_treasury_records(
-                [
-                    (scan_mint_output["payment_output_record"], False),
-                    (scan_mint_output["fee_output_record"], False),
-                    (scan_mint_output["collection_output_record"], True),
-                ]
-            ),
+        dynamodb_buffered_update(
+            env.ALEO_MINT_REQUESTS_TABLE,
+            {"request_id": request_id},
+            {
+                "scan_mint_output": {"Value": scan_mint_output},
+                "request_status": {"Action": "DELETE"},
+            },
+            set_only=False,
         )
+        push_treasury_records(
+            [
+                (scan_mint_output["payment_output_record"], False),
+                (scan_mint_output["fee_output_record"], False),
+            ]
+        )
+        await dynamodb_flush()
         return scan_mint_output
     except Exception as e:
-        await dynamodb_update(
+        dynamodb_buffered_update(
             env.ALEO_MINT_REQUESTS_TABLE,
             {"request_id": request_id},
             {"scan_mint_error": format_error(e)},
@@ -4,25 +4,66 @@ import asyncio
 from termcolor import colored
 import traceback as tb
 import env
+from snarkos_pool import (
+    run_in_worker,
+    run_batch_in_worker,
+    kill_process_group,
+)
+from snarkos_scheduler import snarkos_lane
 
 utc_now_ms = lambda: round(datetime.utcnow().timestamp() * 1000)
 
 
-async def ascync_run(cmd):
-    full_cmd = " ".join([str(el) for el in cmd])
-
+async def run_shell(full_cmd):
     proc = await asyncio.create_subprocess_shell(
         full_cmd,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,
     )
 
-    stdout, stderr = await proc.communicate()
-    stdout = stdout.decode()
-    stderr = stderr.decode()
+    try:
+        stdout, stderr = await proc.communicate()
+    except asyncio.CancelledError:
+        kill_process_group(proc)
+        raise
+    return stdout.decode(), stderr.decode()
+
+
+async def ascync_run(cmd, lane="prove"):
+    full_cmd = " ".join([str(el) for el in cmd])
+
+    async with snarkos_lane(lane):
+        worker_output = await run_in_worker(full_cmd)
+        if worker_output is not None:
+            stdout, stderr = worker_output
+        else:
+            stdout, stderr = await run_shell(full_cmd)
+
+    print_run(full_cmd, stdout, stderr)
+    return stdout
+
+
+async def ascync_run_batch(cmds, lane="decrypt"):
+    full_cmds = [" ".join([str(el) for el in cmd]) for cmd in cmds]
+
+    async with snarkos_lane(
+        lane, min(len(full_cmds), env.SNARKOS_BATCH_CONCURRENCY)
+    ):
+        worker_outputs = await run_batch_in_worker(full_cmds)
+        if worker_outputs is None:
+            worker_outputs = await asyncio.gather(
+                *[run_shell(full_cmd) for full_cmd in full_cmds]
+            )
 
+    for full_cmd, (stdout, stderr) in zip(full_cmds, worker_outputs):
+        print_run(full_cmd, stdout, stderr)
+    return [stdout for stdout, _ in worker_outputs]
+
+
+def print_run(full_cmd, stdout, stderr):
     if "Invalid view key for the provided record ciphertext" in stdout:
-        return stdout
+        return
     print("")
     print("Executing:")
     print(colored(full_cmd, "blue"))
@@ -34,8 +75,6 @@ async def ascync_run(cmd):
         print(colored(stderr, "red"))
     print("")
 
-    return stdout
-
 
 record_to_amount = lambda record: int(
     record.replace(" ", "").replace("\n", "").split(",")[1][13:-11]
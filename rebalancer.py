@@ -0,0 +1,174 @@
+import math
+import uuid
+
+from aleo import (
+    split_credit,
+    join_credits,
+    get_transaction_outputs,
+    load_built_transaction,
+    is_transaction_on_chain,
+    broadcast_built_transaction,
+)
+from aws_utils import dynamodb_flush, dynamodb_scan_items
+from confirmations import wait_for_confirmation
+from snarkos_scheduler import snarkos_priority, PRIORITY_SCAN
+from treasury import (
+    now_s,
+    ensure_treasury_index,
+    claim_treasury_records,
+    push_treasury_records,
+    return_treasury_operation,
+    finish_treasury_operation,
+    select_record_to_split,
+    select_records_to_join,
+    count_treasury_records,
+    recent_allocation_rate,
+)
+from project_utils import format_error
+import env
+
+rebalance_stats = {"splits": 0, "joins": 0}
+
+rebalance_outputs = lambda request_step: {
+    "split": [f"{env.ALEO_CREDITS_PROGRAM_ID}/split"],
+    "join": [
+        f"{env.ALEO_CREDITS_PROGRAM_ID}/join",
+        f"{env.ALEO_CREDITS_PROGRAM_ID}/fee",
+    ],
+}[request_step.split("/")[1]]
+
+
+def get_treasury_band():
+    return (
+        env.TREASURY_TARGET_RECORD_AMOUNT // 2,
+        env.TREASURY_TARGET_RECORD_AMOUNT * 2,
+    )
+
+
+def get_target_record_count():
+    return max(
+        env.TREASURY_MIN_RECORDS,
+        math.ceil(
+            2 * recent_allocation_rate() * env.TREASURY_TARGET_HORIZON_S
+        ),
+    )
+
+
+async def rebalance_treasury():
+    snarkos_priority.set(PRIORITY_SCAN)
+    await recover_rebalance_operations()
+    await ensure_treasury_index()
+    band_min, band_max = get_treasury_band()
+    in_band = count_treasury_records(band_min, band_max)
+    oversized = count_treasury_records(band_max + 1, math.inf)
+    dust = count_treasury_records(0, band_min - 1)
+
+    if in_band < get_target_record_count() and oversized:
+        await split_treasury_record(band_max)
+    elif dust >= 2:
+        await join_treasury_records(band_min)
+
+
+async def split_treasury_record(band_max):
+    request_step = f"rebalance/split/{uuid.uuid4().hex}"
+    (record,) = await claim_treasury_records(
+        lambda: select_record_to_split(band_max), request_step
+    )
+    await run_rebalance_operation(
+        request_step,
+        lambda: split_credit(
+            env.MINT_ACCOUNT_PRIVATE_KEY,
+            record,
+            env.TREASURY_TARGET_RECORD_AMOUNT,
+            request_step=request_step,
+        ),
+    )
+    rebalance_stats["splits"] += 1
+
+
+async def join_treasury_records(band_min):
+    request_step = f"rebalance/join/{uuid.uuid4().hex}"
+    first, second, fee = await claim_treasury_records(
+        lambda: select_records_to_join(band_min, env.JOIN_CREDITS_FEE),
+        request_step,
+        fee_record=True,
+    )
+    await run_rebalance_operation(
+        request_step,
+        lambda: join_credits(
+            env.MINT_ACCOUNT_PRIVATE_KEY,
+            first,
+            second,
+            fee,
+            request_step=request_step,
+        ),
+    )
+    rebalance_stats["joins"] += 1
+
+
+async def run_rebalance_operation(request_step, operation):
+    try:
+        tx_id = await operation()
+    except Exception as e:
+        if await load_built_transaction(request_step) is None:
+            await return_treasury_operation(request_step)
+        raise e
+    try:
+        await wait_for_confirmation(tx_id)
+    except Exception as e:
+        if await load_built_transaction(request_step) is None:
+            await return_treasury_operation(request_step, rejected=True)
+        raise e
+    await push_outputs(request_step, tx_id)
+
+
+async def push_outputs(request_step, tx_id):
+    all_records = await get_transaction_outputs(
+        tx_id, env.MINT_ACCOUNT_VIEW_KEY
+    )
+    push_treasury_records(
+        [
+            (record, False)
+            for transition_id in rebalance_outputs(request_step)
+            for record in all_records.get(transition_id, [])
+            if record
+        ]
+    )
+    await dynamodb_flush()
+    await finish_treasury_operation(request_step)
+
+
+async def recover_rebalance_operations():
+    async for operation in dynamodb_scan_items(
+        env.TREASURY_OPERATIONS_TABLE,
+        filter_expression="begins_with(request_step, :prefix)",
+        ExpressionAttributeValues={":prefix": {"S": "rebalance/"}},
+    ):
+        try:
+            await recover_rebalance_operation(operation)
+        except Exception as e:
+            print(format_error(e))
+
+
+async def recover_rebalance_operation(operation):
+    request_step = operation["request_step"]
+    age_s = now_s() - operation["created_at"]
+    transaction = await load_built_transaction(request_step)
+    if transaction is None:
+        if age_s > env.TREASURY_LEASE_S:
+            await return_treasury_operation(request_step)
+        return
+    if await is_transaction_on_chain(transaction["id"]):
+        await push_outputs(request_step, transaction["id"])
+    elif age_s > env.CONFIRMATION_TIMEOUT_S:
+        await broadcast_built_transaction(transaction, request_step)
+
+
+def format_rebalance_stats():
+    band_min, band_max = get_treasury_band()
+    return (
+        f"rebalancer: {count_treasury_records(band_min, band_max)}/"
+        f"{get_target_record_count()} records in band, "
+        f"{rebalance_stats['splits']} splits, "
+        f"{rebalance_stats['joins']} joins"
+    )
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+from os import path
+from snarkos_scheduler import get_lanes
+import env
+
+WORKER_PATH = path.join(
+    path.dirname(path.abspath(__file__)), "snarkos_worker.py"
+)
+WORKER_STREAM_LIMIT = 64 * 1024 * 1024
+
+snarkos_workers = None
+snarkos_pool_size = 0
+snarkos_pool_stats = {
+    "workers": 0,
+    "busy": 0,
+    "requests": 0,
+    "fallbacks": 0,
+    "busy_time_s": 0.0,
+    "started_at": None,
+}
+next_request_id = 0
+
+
+async def start_worker():
+    worker = await asyncio.create_subprocess_exec(
+        sys.executable,
+        WORKER_PATH,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        limit=WORKER_STREAM_LIMIT,
+        start_new_session=True,
+    )
+    snarkos_pool_stats["workers"] += 1
+    return worker
+
+
+def get_idle_workers():
+    global snarkos_workers, snarkos_pool_size
+    if snarkos_workers is None:
+        snarkos_workers = asyncio.Queue()
+        snarkos_pool_size = sum(lane["size"] for lane in get_lanes().values())
+        for _ in range(snarkos_pool_size):
+            snarkos_workers.put_nowait(None)
+        snarkos_pool_stats["started_at"] = time.monotonic()
+    return snarkos_workers
+
+
+def discard_worker(worker):
+    if worker is None:
+        return
+    kill_process_group(worker)
+    snarkos_pool_stats["workers"] -= 1
+
+
+def kill_process_group(proc):
+    if proc.returncode is not None:
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def run_in_worker(full_cmd):
+    response = await request_worker({"cmd": full_cmd})
+    if response is None:
+        return None
+    return response["stdout"], response["stderr"]
+
+
+async def run_batch_in_worker(full_cmds):
+    response = await request_worker(
+        {"cmds": full_cmds, "concurrency": env.SNARKOS_BATCH_CONCURRENCY}
+    )
+    if response is None:
+        return None
+    return [
+        (result["stdout"], result["stderr"]) for result in response["results"]
+    ]
+
+
+async def request_worker(request):
+    global next_request_id
+    if not env.SNARKOS_POOL:
+        return None
+
+    idle_workers = get_idle_workers()
+    worker = await idle_workers.get()
+    snarkos_pool_stats["busy"] += 1
+    started_at = time.monotonic()
+    try:
+        if worker is not None and worker.returncode is not None:
+            discard_worker(worker)
+            worker = None
+        if worker is None:
+            worker = await start_worker()
+        next_request_id += 1
+        request = {"id": next_request_id, **request}
+        worker.stdin.write((json.dumps(request) + "\n").encode())
+        await worker.stdin.drain()
+        line = await worker.stdout.readline()
+        if not line:
+            raise Exception("snarkos worker exited.")
+        response = json.loads(line)
+        if response["id"] != request["id"]:
+            raise Exception("snarkos worker answered another request.")
+        snarkos_pool_stats["requests"] += 1
+        return response
+    except asyncio.CancelledError:
+        discard_worker(worker)
+        worker = None
+        raise
+    except Exception as e:
+        print("snarkos worker failed, running one-shot command:", e)
+        discard_worker(worker)
+        worker = None
+        snarkos_pool_stats["fallbacks"] += 1
+        return None
+    finally:
+        snarkos_pool_stats["busy"] -= 1
+        snarkos_pool_stats["busy_time_s"] += time.monotonic() - started_at
+        idle_workers.put_nowait(worker)
+
+
+async def close_snarkos_pool():
+    global snarkos_workers
+    if snarkos_workers is None:
+        return
+    while not snarkos_workers.empty():
+        worker = snarkos_workers.get_nowait()
+        if worker is not None:
+            worker.stdin.close()
+            await worker.wait()
+            snarkos_pool_stats["workers"] -= 1
+    snarkos_workers = None
+
+
+def format_snarkos_pool_stats():
+    if snarkos_pool_stats["started_at"] is None:
+        return "snarkos pool idle"
+    elapsed_s = time.monotonic() - snarkos_pool_stats["started_at"]
+    utilisation = snarkos_pool_stats["busy_time_s"] / max(
+        elapsed_s * snarkos_pool_size, 1e-9
+    )
+    return (
+        f"snarkos pool: {snarkos_pool_stats['busy']}/{snarkos_pool_size} "
+        f"busy, {snarkos_pool_stats['workers']} running, "
+        f"{utilisation:.0%} utilisation, "
+        f"{snarkos_pool_stats['requests']} requests, "
+        f"{snarkos_pool_stats['fallbacks']} fallbacks"
+    )
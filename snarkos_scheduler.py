@@ -0,0 +1,104 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+import env
+
+PRIORITY_REQUEST = 0
+PRIORITY_SCAN = 1
+
+snarkos_priority = contextvars.ContextVar(
+    "snarkos_priority", default=PRIORITY_REQUEST
+)
+snarkos_lanes = None
+next_waiter_sequence = itertools.count()
+
+
+def get_lanes():
+    global snarkos_lanes
+    if snarkos_lanes is None:
+        cpu_count = os.cpu_count() or 1
+        snarkos_lanes = {
+            lane_name: {
+                "size": max(1, cpu_count // cores_per_slot),
+                "free": max(1, cpu_count // cores_per_slot),
+                "waiters": [],
+                "running": 0,
+                "acquired": 0,
+                "wait_time_s": 0.0,
+                "max_wait_s": 0.0,
+            }
+            for lane_name, cores_per_slot in (
+                ("prove", env.SNARKOS_CORES_PER_PROOF),
+                ("decrypt", env.SNARKOS_CORES_PER_DECRYPT),
+            )
+        }
+    return snarkos_lanes
+
+
+def wake_waiters(lane):
+    while lane["waiters"] and lane["waiters"][0][2] <= lane["free"]:
+        _, _, weight, waiter = heapq.heappop(lane["waiters"])
+        lane["free"] -= weight
+        waiter.set_result(None)
+
+
+def release_slots(lane, weight):
+    lane["free"] += weight
+    wake_waiters(lane)
+
+
+async def acquire_slots(lane, weight):
+    if not lane["waiters"] and lane["free"] >= weight:
+        lane["free"] -= weight
+        return
+    waiter = asyncio.get_running_loop().create_future()
+    heapq.heappush(
+        lane["waiters"],
+        (snarkos_priority.get(), next(next_waiter_sequence), weight, waiter),
+    )
+    try:
+        await waiter
+    except asyncio.CancelledError:
+        if waiter.done() and not waiter.cancelled():
+            release_slots(lane, weight)
+        else:
+            lane["waiters"] = [
+                queued for queued in lane["waiters"] if queued[3] is not waiter
+            ]
+            heapq.heapify(lane["waiters"])
+            wake_waiters(lane)
+        raise
+
+
+@asynccontextmanager
+async def snarkos_lane(lane_name, weight=1):
+    lane = get_lanes()[lane_name]
+    weight = min(weight, lane["size"])
+    queued_at = time.monotonic()
+    await acquire_slots(lane, weight)
+    wait_s = time.monotonic() - queued_at
+    lane["acquired"] += 1
+    lane["wait_time_s"] += wait_s
+    lane["max_wait_s"] = max(lane["max_wait_s"], wait_s)
+    lane["running"] += 1
+    try:
+        yield
+    finally:
+        lane["running"] -= 1
+        release_slots(lane, weight)
+
+
+def format_snarkos_scheduler_stats():
+    if snarkos_lanes is None:
+        return "snarkos lanes idle"
+    return "snarkos lanes: " + "; ".join(
+        f"{lane_name} {lane['size'] - lane['free']}/{lane['size']} slots "
+        f"used, {lane['running']} running, {len(lane['waiters'])} queued, "
+        f"avg wait {lane['wait_time_s'] / max(lane['acquired'], 1):.2f}s, "
+        f"max wait {lane['max_wait_s']:.2f}s"
+        for lane_name, lane in snarkos_lanes.items()
+    )
@@ -0,0 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import shlex
+import subprocess
+import sys
+
+
+def run_command(cmd):
+    try:
+        proc = subprocess.run(shlex.split(cmd), capture_output=True)
+    except OSError as e:
+        return {"stdout": "", "stderr": str(e)}
+    return {
+        "stdout": proc.stdout.decode(errors="replace"),
+        "stderr": proc.stderr.decode(errors="replace"),
+    }
+
+
+if __name__ == "__main__":
+    for line in sys.stdin:
+        request = json.loads(line)
+        if "cmds" in request:
+            with ThreadPoolExecutor(request["concurrency"]) as executor:
+                results = list(executor.map(run_command, request["cmds"]))
+            response = {"id": request["id"], "results": results}
+        else:
+            response = {"id": request["id"], **run_command(request["cmd"])}
+        sys.stdout.write(json.dumps(response) + "\n")
+        sys.stdout.flush()
@@ -0,0 +1,38 @@
+import asyncio
+
+
+async def run_step_graph(steps):
+    outputs = {}
+    failures = []
+    waiting = dict(steps)
+    running = {}
+    try:
+        while True:
+            if not failures:
+                for name, (dependencies, make_step) in list(waiting.items()):
+                    if all(
+                        dependency in outputs for dependency in dependencies
+                    ):
+                        del waiting[name]
+                        task = asyncio.ensure_future(make_step(outputs))
+                        running[task] = name
+            if not running:
+                break
+            done, _ = await asyncio.wait(
+                running, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                name = running.pop(task)
+                if task.exception() is not None:
+                    failures.append(task.exception())
+                    continue
+                outputs[name] = task.result()
+    finally:
+        for task in running:
+            task.cancel()
+
+    if failures:
+        raise failures[0]
+    if waiting:
+        raise Exception(f"Steps never became ready: {', '.join(waiting)}")
+    return outputs
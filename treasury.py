@@ -0,0 +1,304 @@
+import asyncio
+import time
+import uuid
+from bisect import bisect_left
+from collections import deque
+
+from aws_utils import (
+    dynamodb_get,
+    dynamodb_update,
+    dynamodb_scan_items,
+    dynamodb_conditional_update,
+    dynamodb_delete,
+    dynamodb_buffered_update,
+    dynamodb_flush,
+)
+from project_utils import utc_now_ms, record_to_amount
+import env
+
+LEASE_OWNER = uuid.uuid4().hex
+
+treasury_index = []
+collection_records = []
+treasury_loaded_at = None
+treasury_load_lock = None
+pushed_while_loading = None
+allocation_times = deque()
+treasury_stats = {"allocations": 0, "reservation_conflicts": 0}
+
+now_s = lambda: utc_now_ms() // 1000
+min_payment_amount = lambda: env.TRANSFER_LEOS_FEE + max(
+    env.MINT_LEOS_FEE, env.BURN_LEOS_FEE
+)
+min_fee_amount = lambda: env.TRANSFER_CREDITS_FEE + env.TRANSFER_LEOS_FEE
+
+
+async def load_treasury_index():
+    global treasury_index, collection_records, treasury_loaded_at
+    global pushed_while_loading
+    pushed_while_loading = []
+    index = []
+    collections = []
+    try:
+        async for record_scanned in dynamodb_scan_items(
+            env.ALEO_TREASURY_RECORDS_TABLE,
+            projection_expression="record_id, collection_record, "
+            "record_amount, leased_until",
+            segments=env.TREASURY_SCAN_SEGMENTS,
+        ):
+            if record_scanned.get("leased_until", 0) > now_s():
+                continue
+            if record_scanned.get("collection_record"):
+                collections.append(record_scanned["record_id"])
+                continue
+            amount = record_scanned.get("record_amount")
+            if amount is None:
+                amount = record_to_amount(record_scanned["record_id"])
+            index.append((int(amount), record_scanned["record_id"]))
+        index.sort()
+        treasury_index, collection_records = index, collections
+        for record, collection, amount in pushed_while_loading:
+            add_to_index(record, collection, amount)
+        treasury_loaded_at = time.monotonic()
+    finally:
+        pushed_while_loading = None
+
+
+async def ensure_treasury_index():
+    global treasury_load_lock
+    if treasury_load_lock is None:
+        treasury_load_lock = asyncio.Lock()
+    async with treasury_load_lock:
+        if (
+            treasury_loaded_at is None
+            or time.monotonic() - treasury_loaded_at
+            > env.TREASURY_INDEX_REFRESH_S
+        ):
+            await load_treasury_index()
+
+
+def add_to_index(record, collection, amount):
+    if collection:
+        if record not in collection_records:
+            collection_records.append(record)
+        return
+    position = bisect_left(treasury_index, (amount, record))
+    if treasury_index[position : position + 1] != [(amount, record)]:
+        treasury_index.insert(position, (amount, record))
+
+
+def select_treasury_records():
+    payment_position = bisect_left(treasury_index, (min_payment_amount(),))
+    if (
+        len(treasury_index) - payment_position < 2
+        or treasury_index[-1][0] < min_fee_amount()
+    ):
+        raise Exception("Not enough records in treasury.")
+    payment = treasury_index.pop(payment_position)
+    fee = treasury_index.pop()
+    return [(payment, False), (fee, False)]
+
+
+def select_collection_record():
+    if not collection_records:
+        raise Exception("No collection record in treasury.")
+    return [(collection_records.pop(0), True)]
+
+
+def select_record_to_split(min_amount):
+    if not treasury_index or treasury_index[-1][0] <= min_amount:
+        raise Exception("No treasury record to split.")
+    return [(treasury_index.pop(), False)]
+
+
+def select_records_to_join(max_amount, fee_amount):
+    dust_count = bisect_left(treasury_index, (max_amount,))
+    if (
+        dust_count < 2
+        or len(treasury_index) < 3
+        or treasury_index[-1][0] < fee_amount
+    ):
+        raise Exception("No treasury records to join.")
+    fee = treasury_index.pop()
+    first = treasury_index.pop(0)
+    second = treasury_index.pop(0)
+    return [(first, False), (second, False), (fee, False)]
+
+
+def count_treasury_records(min_amount, max_amount):
+    return bisect_left(treasury_index, (max_amount + 1,)) - bisect_left(
+        treasury_index, (min_amount,)
+    )
+
+
+def return_to_index(selected):
+    for entry, collection in selected:
+        if collection:
+            add_to_index(entry, True, None)
+        else:
+            add_to_index(entry[1], False, entry[0])
+
+
+async def reserve_treasury_record(record):
+    return await dynamodb_conditional_update(
+        env.ALEO_TREASURY_RECORDS_TABLE,
+        {"record_id": record},
+        {
+            "leased_until": now_s() + env.TREASURY_LEASE_S,
+            "lease_owner": LEASE_OWNER,
+        },
+        "attribute_exists(record_id) and (attribute_not_exists(leased_until) "
+        "or leased_until < :now)",
+        {":now": {"N": str(now_s())}},
+    )
+
+
+async def release_treasury_record(record):
+    return await dynamodb_conditional_update(
+        env.ALEO_TREASURY_RECORDS_TABLE,
+        {"record_id": record},
+        {"leased_until": 0},
+        "lease_owner = :owner",
+        {":owner": {"S": LEASE_OWNER}},
+    )
+
+
+async def allocate_treasury_records():
+    records = await claim_treasury_records(select_treasury_records)
+    allocation_times.append(time.monotonic())
+    treasury_stats["allocations"] += 1
+    return records
+
+
+async def claim_treasury_records(
+    select_records, request_step=None, fee_record=False
+):
+    await dynamodb_flush()
+    await ensure_treasury_index()
+    while True:
+        selected = select_records()
+        records = [
+            entry if collection else entry[1] for entry, collection in selected
+        ]
+        try:
+            reserved = await asyncio.gather(
+                *[reserve_treasury_record(record) for record in records]
+            )
+        except Exception as e:
+            return_to_index(selected)
+            raise e
+        if all(reserved):
+            break
+        treasury_stats["reservation_conflicts"] += 1
+        await asyncio.gather(
+            *[
+                release_treasury_record(record)
+                for record, is_reserved in zip(records, reserved)
+                if is_reserved
+            ]
+        )
+        return_to_index(
+            [
+                selected_record
+                for selected_record, is_reserved in zip(selected, reserved)
+                if is_reserved
+            ]
+        )
+
+    if request_step is not None:
+        await save_treasury_operation(
+            request_step,
+            records[:-1] if fee_record else records,
+            selected[0][1],
+            records[-1] if fee_record else None,
+        )
+    await asyncio.gather(
+        *[
+            dynamodb_delete(
+                env.ALEO_TREASURY_RECORDS_TABLE,
+                {"record_id": record},
+                condition_expression="lease_owner = :owner",
+                ExpressionAttributeValues={":owner": {"S": LEASE_OWNER}},
+            )
+            for record in records
+        ]
+    )
+    return tuple(records)
+
+
+async def save_treasury_operation(
+    request_step, records, collection, fee_record=None
+):
+    changes = {
+        "records": records,
+        "collection_record": collection,
+        "created_at": now_s(),
+    }
+    if fee_record is not None:
+        changes["fee_record"] = fee_record
+    await dynamodb_update(
+        env.TREASURY_OPERATIONS_TABLE, {"request_step": request_step}, changes
+    )
+
+
+async def load_treasury_operation(request_step):
+    return await dynamodb_get(
+        env.TREASURY_OPERATIONS_TABLE, {"request_step": request_step}
+    )
+
+
+async def return_treasury_operation(request_step, rejected=False):
+    operation = await load_treasury_operation(request_step)
+    if operation is None:
+        return
+    records = list(operation["records"])
+    if operation.get("fee_record") and not rejected:
+        records.append(operation["fee_record"])
+    push_treasury_records(
+        [(record, operation["collection_record"]) for record in records]
+    )
+    await dynamodb_flush()
+    await finish_treasury_operation(request_step)
+
+
+async def finish_treasury_operation(request_step):
+    await dynamodb_delete(
+        env.TREASURY_OPERATIONS_TABLE, {"request_step": request_step}
+    )
+
+
+def push_treasury_records(records):
+    for record, collection in records:
+        amount = None if collection else record_to_amount(record)
+        changes = {"used_already": False, "collection_record": collection}
+        if amount is not None:
+            changes["record_amount"] = amount
+        dynamodb_buffered_update(
+            env.ALEO_TREASURY_RECORDS_TABLE,
+            {"record_id": record},
+            changes,
+            put=True,
+        )
+        if pushed_while_loading is not None:
+            pushed_while_loading.append((record, collection, amount))
+        add_to_index(record, collection, amount)
+
+
+def treasury_snapshot():
+    return [record for _, record in treasury_index], list(collection_records)
+
+
+def recent_allocation_rate():
+    window_start = time.monotonic() - env.TREASURY_RATE_WINDOW_S
+    while allocation_times and allocation_times[0] < window_start:
+        allocation_times.popleft()
+    return len(allocation_times) / env.TREASURY_RATE_WINDOW_S
+
+
+def format_treasury_stats():
+    return (
+        f"treasury: {len(treasury_index)} records, "
+        f"{len(collection_records)} collection records, "
+        f"{treasury_stats['allocations']} allocations, "
+        f"{treasury_stats['reservation_conflicts']} reservation conflicts"
+    )
@@ -0,0 +1,108 @@
+import asyncio
+import time
+
+from aleo import execute_command
+from aws_utils import open_dynamodb_clients, close_dynamodb_clients
+from http_utils import close_aiohttp_session
+from treasury import ensure_treasury_index, treasury_snapshot
+from project_utils import ascync_run, format_error
+from snarkos_pool import close_snarkos_pool
+import env
+
+quote = lambda record: f'"{record}"'
+
+
+async def get_warmup_records():
+    await ensure_treasury_index()
+    credit_records, _ = treasury_snapshot()
+    return credit_records
+
+
+def get_warmup_executions(credit_records):
+    executions = {
+        f"{env.ALEO_CREDITS_PROGRAM_ID}/transfer_private": None,
+        f"{env.ALEO_CREDITS_PROGRAM_ID}/split": None,
+        f"{env.ALEO_CREDITS_PROGRAM_ID}/join": None,
+    }
+    credit_records = [quote(record) for record in credit_records]
+
+    if len(credit_records) >= 2:
+        executions[f"{env.ALEO_CREDITS_PROGRAM_ID}/transfer_private"] = (
+            env.ALEO_CREDITS_PROGRAM_ID,
+            "transfer_private",
+            [credit_records[0], env.MINT_ACCOUNT_ADDRESS, "1u64"],
+            credit_records[1],
+        )
+    if len(credit_records) >= 1:
+        executions[f"{env.ALEO_CREDITS_PROGRAM_ID}/split"] = (
+            env.ALEO_CREDITS_PROGRAM_ID,
+            "split",
+            [credit_records[0], "1u64"],
+            None,
+        )
+    if len(credit_records) >= 3:
+        executions[f"{env.ALEO_CREDITS_PROGRAM_ID}/join"] = (
+            env.ALEO_CREDITS_PROGRAM_ID,
+            "join",
+            [credit_records[0], credit_records[1]],
+            credit_records[2],
+        )
+    return executions
+
+
+async def warmup():
+    started_at = time.monotonic()
+    try:
+        executions = get_warmup_executions(await get_warmup_records())
+    except Exception as e:
+        print("Warmup skipped:", format_error(e))
+        return
+
+    report = []
+    for function_id, execution in executions.items():
+        if execution is None:
+            report.append(f"{function_id}: skipped, no input record")
+            continue
+        program_id, function_name, inputs, fee_record = execution
+        function_started_at = time.monotonic()
+        try:
+            stdout = await ascync_run(
+                execute_command(
+                    program_id,
+                    function_name,
+                    inputs,
+                    env.MINT_ACCOUNT_PRIVATE_KEY,
+                    fee_record,
+                    action=["--dry-run"],
+                )
+            )
+            if "✅" not in stdout:
+                raise Exception(stdout)
+            status = "warmed"
+        except Exception as e:
+            print(format_error(e))
+            status = "failed"
+        report.append(
+            f"{function_id}: {status} in "
+            f"{time.monotonic() - function_started_at:.1f}s"
+        )
+
+    print(f"Warmup done in {time.monotonic() - started_at:.1f}s")
+    for line in report:
+        print(line)
+
+
+async def main():
+    await open_dynamodb_clients()
+    try:
+        await warmup()
+    finally:
+        await asyncio.gather(
+            close_aiohttp_session(),
+            close_dynamodb_clients(),
+            close_snarkos_pool(),
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())